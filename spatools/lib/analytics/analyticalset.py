@@ -2,7 +2,8 @@
 from collections import defaultdict
 from spatools.lib.analytics.dataframes import AlleleDataFrame
 #from spatools.lib.analytics.dataframes import GenotypeDataFrame
-from pandas import pivot_table
+import numpy as np
+from pandas import Index, pivot_table
 from pprint import pprint
 
 class AnalyticalSet(object):
@@ -12,8 +13,9 @@ class AnalyticalSet(object):
         _marker_df:
     """
 
-    def __init__(self, sample_set, params, marker_ids, dbh):
-        assert sample_set and params and dbh
+    def __init__(self, sample_set, params, marker_ids, dbh, allele_df=None):
+        """ if allele_df is provided, it is used instead of fetching from dbh """
+        assert sample_set is not None and params and (dbh or allele_df)
 
         self._sample_set = sample_set
         self._params = params
@@ -22,11 +24,13 @@ class AnalyticalSet(object):
             marker_ids = params.get_marker_ids(dbh)
         self._marker_ids = marker_ids
 
-        self._allele_df = AlleleDataFrame(dbh,
+        if allele_df is None:
+            allele_df = AlleleDataFrame(dbh,
                     sample_ids = self.sample_ids,
                     marker_ids = marker_ids,
                     params = params
             )
+        self._allele_df = allele_df
 
         # placeholder
 
@@ -50,6 +54,9 @@ class AnalyticalSet(object):
 
     @property
     def marker_ids(self):
+        if self._allele_df.marker_ids is None:
+            # no marker selection, use all genotyped loci
+            return self.genotype_matrix.locus_ids.tolist()
         return self._allele_df.marker_ids
 
     @property
@@ -81,24 +88,26 @@ class AnalyticalSet(object):
                     index = 'sample_id', columns = 'marker_id', values='value', aggfunc = len )
         return self._marker_df
 
+    @property
+    def genotype_matrix(self):
+        return self._allele_df.genotype_matrix
+
     @property
     def variant_df(self):
         if self._variant_df is None:
-            self._variant_df = pivot_table( self._allele_df.df, index = 'sample_id', columns = 'locus_id', values='call',
-                aggfunc = lambda x: x )
+            self._variant_df = self.genotype_matrix.to_dataframe()
         return self._variant_df
 
     marker_df = variant_df
 
     @property
     def sample_marker(self):
+        """ return dict of sample_id: set of genotyped marker_ids """
         if self._sample_marker is None:
-            self._sample_marker = {}
-            for (idx, marker_id, sample_id, base, A, C, G, T, genotype_id) in self.allele_df.df.itertuples():
-                try:
-                    self._sample_marker[sample_id].add( marker_id )
-                except KeyError:
-                    self._sample_marker[sample_id] = { marker_id }   # create initial set
+            matrix = self.genotype_matrix
+            genotyped = ~matrix.missing
+            self._sample_marker = { sample_id: set( matrix.locus_ids[genotyped[i]].tolist() )
+                                    for (i, sample_id) in enumerate(matrix.sample_ids.tolist()) }
         return self._sample_marker
 
 
@@ -163,17 +172,16 @@ class AnalyticalSet(object):
     def assess_sample_quality(self, sample_qual_threshold = -1):
         """ assess sample based on successful genotyped markers
             param: sample_qual_threshold
+            return: (set of passed sample_ids, array of genotyped markers per sample)
         """
 
-        sample_quality = [ (s_id, len(m)) for s_id, m in self.sample_marker.items() ]
-        genotyped_dist = [ x[1] for x in sample_quality ]
-        #n = max(genotyped_dist)
+        matrix = self.genotype_matrix
+        genotyped_dist = matrix.genotyped_per_sample()
         n = len(self.marker_ids)
         if sample_qual_threshold < 0:
             sample_qual_threshold = self._params.sample_qual_threshold
         threshold = n * sample_qual_threshold
-        passed_sample_ids = set([ int(x[0]) for x in sample_quality if x[1] >= threshold ])
-        #failed_samples = len(sample_quality) - len(passed_sample_ids)
+        passed_sample_ids = set( matrix.sample_ids[genotyped_dist >= threshold].tolist() )
 
         return (passed_sample_ids, genotyped_dist)
 
@@ -182,43 +190,74 @@ class AnalyticalSet(object):
         """ assess marker based on successful genotyped samples, which must be done on
             all samples!!
             param: marker_qual_threshold
+            return: (set of passed marker_ids, array of genotyped samples per marker
+                    in the order of marker_ids)
         """
-        marker_genotyped = []
-        for marker_id in self.marker_ids:
-            # variant_df (or marker_df) contains [ 'A' 'C' 'C' 'G' ...]
-            genotyped = 0
-            for m in self.marker_df.get(marker_id, [0]):
-                if m != 'X':
-                    genotyped += 1
-            marker_genotyped.append( (marker_id, genotyped) )
+        matrix = self.genotype_matrix
+        marker_ids = np.asarray(self.marker_ids, dtype=np.int64)
+        pos = Index(matrix.locus_ids).get_indexer(marker_ids)
+        marker_genotyped = np.where( pos >= 0, matrix.genotyped_per_locus()[pos], 0 )
 
         if marker_qual_threshold < 0:
             marker_qual_threshold = self._params.marker_qual_threshold
         threshold = len(self.sample_ids) * marker_qual_threshold
-        passed_marker_ids = set([ x[0] for x in marker_genotyped if x[1] >= threshold ])
+        passed_marker_ids = set( marker_ids[marker_genotyped >= threshold].tolist() )
         return (passed_marker_ids, marker_genotyped)
 
 
     def get_filtered_analytical_set(self, sample_ids=None, marker_ids=None):
+        """ return a new analytical set with only sample_ids and marker_ids,
+            by masking the already loaded allele dataframe
+        """
+
+        if sample_ids is None and marker_ids is None:
+            return self
 
-        if not (sample_ids or marker_ids):
-            return None
+        sample_set = self._sample_set
+        if sample_ids is not None:
+            sample_set = sample_set.filtered( set(sample_ids) )
+        if marker_ids is None:
+            marker_ids = self._marker_ids
 
-        raise NotImplementedError()
+        allele_df = self._allele_df.filtered( sample_set.sample_ids, marker_ids )
+        return self.__class__( sample_set, self._params, marker_ids, None,
+                                allele_df = allele_df )
 
 
 class AnalyticalSetContainer(list):
 
-    def __init__(self, sample_sets, params, marker_ids, dbh):
+    def __init__(self, sample_sets, params, marker_ids, dbh, analytical_sets=None,
+                    allele_df=None):
+        """ if analytical_sets is provided, they are used instead of fetching
+            from dbh; if allele_df (an AlleleDataFrame of all sample sets) is
+            provided, it is split instead of fetching from dbh
+        """
         super().__init__()
         self._sample_sets = sample_sets
         self._params = params
         self._total_samples = 0
         self._sample_ids = set()
         self._marker_ids = set(marker_ids) if marker_ids else None
-        for s in self._sample_sets:
-            if len(s) <= 0: continue
-            a_set = AnalyticalSet( s, params, marker_ids, dbh )
+        self._shared_allele_df = allele_df
+
+        if analytical_sets is None:
+            # fetch the union of all sample sets once, and give each analytical
+            # set a view of the shared allele dataframe
+            sample_sets = [ s for s in self._sample_sets if len(s) > 0 ]
+            if not marker_ids:
+                marker_ids = params.get_marker_ids(dbh)
+            if self._shared_allele_df is None:
+                self._shared_allele_df = AlleleDataFrame(dbh,
+                    sample_ids = set().union( *[ s.sample_ids for s in sample_sets ] ),
+                    marker_ids = marker_ids,
+                    params = params
+                )
+            allele_dfs = self._shared_allele_df.split( [ s.sample_ids for s in sample_sets ] )
+            analytical_sets = [ AnalyticalSet( s, params, marker_ids, dbh, allele_df = allele_df )
+                                for s, allele_df in zip(sample_sets, allele_dfs) ]
+
+        for a_set in analytical_sets:
+            s = a_set.sample_set
             self.append( a_set )
             self._total_samples += s.N
             self._sample_ids.update( s.sample_ids )
@@ -256,15 +295,30 @@ class AnalyticalSetContainer(list):
         # collect all necessary data from each analyticalset
         marker_counts = defaultdict( int )
         for s in self:
-            for (marker_id, count) in s.get_marker_genotyped_distribution():
+            counts = s.get_marker_genotyped_distribution()
+            for (marker_id, count) in zip( s.marker_ids, counts.tolist() ):
                 marker_counts[marker_id] += count
 
         return marker_counts
 
 
-    def get_filtered_analytical_sets(self):
-        """ return a filtered analytical set container """
-        raise NotImplementedError
+    def get_filtered_analytical_sets(self, sample_ids=None, marker_ids=None):
+        """ return a new analytical set container with only sample_ids and
+            marker_ids, filtered in memory without querying the database
+        """
+        if sample_ids is None and marker_ids is None:
+            return self
+
+        sample_sets = self._sample_sets
+        if sample_ids is not None:
+            sample_sets = sample_sets.filtered( set(sample_ids) )
+        analytical_sets = [ a_set.get_filtered_analytical_set(sample_ids, marker_ids)
+                            for a_set in self ]
+        analytical_sets = [ a_set for a_set in analytical_sets if a_set.N > 0 ]
+
+        return self.__class__( sample_sets, self._params,
+                    marker_ids if marker_ids is not None else self._marker_ids,
+                    None, analytical_sets = analytical_sets )
 
 
     @property
@@ -272,6 +326,12 @@ class AnalyticalSetContainer(list):
         return self._total_samples
 
 
+    @property
+    def shared_allele_df(self):
+        """ AlleleDataFrame of all sample sets, or None for filtered container """
+        return self._shared_allele_df
+
+
     @property
     def sample_ids(self):
         return self._sample_ids
@@ -283,10 +343,11 @@ class AnalyticalSetContainer(list):
 
 
 
-def get_analytical_sets(dbh, sample_sets, params, marker_ids=None):
+def get_analytical_sets(dbh, sample_sets, params, marker_ids=None, allele_df=None):
 
     assert sample_sets and params
-    sets = AnalyticalSetContainer( sample_sets, params, marker_ids, dbh )
+    sets = AnalyticalSetContainer( sample_sets, params, marker_ids, dbh,
+                                    allele_df = allele_df )
 
     return sets
 
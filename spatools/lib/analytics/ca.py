@@ -2,42 +2,131 @@
 # Component Analysis
 #
 # PCoA (Principal Coordinate Analysis)
-#   PCA with distance matrix, using Python MDP library
+#   classical MDS of distance matrix, using partial eigendecomposition
 # MCA (Multiple Correspondence Analysis)
-#   PCA with categorical data, using R FactoMineR library
+#   correspondence analysis of sparse indicator matrix of categorical data
 #
 
 import numpy as np
 import matplotlib.pyplot as plt
-import mdp
-
-def jitters( data ):
-    """ returning normal distribution noise for data jittering"""
-    # need to calculate s based on the smallest and longest distance of the points
-    d_min = d_max = np.abs(data[0] - data[1])
-    for i in range(len(data)):
-        for j in range(len(data)):
-            d = np.abs( data[i] - data[j] )
-            if d > 0:
-                if d > d_max:
-                    d_max = d
-                elif d < d_min:
-                    d_min = d
+from scipy.sparse import csr_matrix, issparse
+from scipy.sparse.linalg import eigsh, svds, LinearOperator
+from spatools.lib.analytics.genotype import call_codes, missing_code
+from spatools.lib.utils import cverr
+
+def jitters( data, rng = None ):
+    """ returning normal distribution noise for data jittering, scaled by the
+        ratio of the smallest positive gap to the range of the data
+    """
+    data = np.sort( np.asarray(data) )
+    if len(data) < 2 or data[-1] == data[0]:
+        return np.zeros( len(data) )
+    gaps = np.diff(data)
+    d_min = gaps[gaps > 0].min()
+    d_max = data[-1] - data[0]
 
     s = d_min / d_max * len(data) / 2
-    print("Jitters:", s)
-    return s * np.random.randn( len(data) )
-
+    cverr(2, 'Jitters: %f' % s)
+    rng = rng or np.random.default_rng()
+    return s * rng.standard_normal( len(data) )
 
-def pcoa( distance_matrix, dim = 2 ):
 
-    pcan = mdp.nodes.PCANode( output_dim = dim )
-    pcar = pcan.execute( distance_matrix.M )
+def jitter_coordinates( pca_result, seed = None ):
+    """ return new (coordinates, variance) with jittered coordinates,
+        use seed for reproducible plots
+    """
+    rng = np.random.default_rng(seed)
+    pcar = np.array( pca_result[0], dtype=np.float64 )
+    for i in range(pcar.shape[1]):
+        pcar[:, i] += jitters( pcar[:, i], rng )
+    return (pcar, pca_result[1])
+
+
+def pcoa( distance_matrix, dim = 2, method = 'eigsh', seed = None ):
+    """ classical PCoA (Torgerson MDS) of distance matrix
+        method is 'eigsh' (ARPACK) or 'randomized' for the first dim axes;
+        with condensed storage, each product with B is a pass over the row
+        blocks, of which 'randomized' needs fewer but is less accurate
+        return: (samples x dim coordinates, percentage of variance of each axis),
+        use jitter_coordinates() to separate overlapping points for plotting
+    """
 
-    for i in range(dim):
-        pcar[:, i] += jitters( pcar[:, i])
+    if distance_matrix.storage == 'dense':
+        B = double_centre( distance_matrix.square(np.float32) )
+        # the total variance is the sum of all eigenvalues, ie. the trace
+        total = float( np.trace(B, dtype=np.float64) )
+    else:
+        # condensed storage is never expanded to a square matrix
+        B, total = centred_operator( distance_matrix )
+    values, vectors = top_eigen( B, dim, method, seed )
+    del B
+
+    pcar = vectors * np.sqrt( np.maximum(values, 0) )
+    return (pcar, values / total * 100 if total > 0 else values)
+
+
+def double_centre( D ):
+    """ return B = -1/2 J D^2 J, computed in place on D """
+    np.square(D, out=D)
+    D *= -0.5
+    # D is symmetric, hence row means are also column means
+    means = D.mean(axis=1, dtype=np.float64)
+    grand_mean = means.mean()
+    means = means.astype(D.dtype)
+    D -= means[:, None]
+    D -= means[None, :]
+    D += D.dtype.type(grand_mean)
+    return D
+
+
+def centred_operator( distance_matrix ):
+    """ return (LinearOperator of B = -1/2 J D^2 J, trace of B), applying B
+        from row blocks of the distance matrix
+    """
+    n = distance_matrix.n
+    means = np.empty(n, dtype=np.float64)
+    for start, rows in distance_matrix.iter_blocks():
+        means[start:start + len(rows)] = np.square(rows, dtype=np.float64).mean(axis=1)
+    grand_mean = means.mean()
+
+    def matmat(X):
+        X = np.asarray(X, dtype=np.float64).reshape(n, -1)
+        Y = np.empty_like(X)
+        for start, rows in distance_matrix.iter_blocks():
+            Y[start:start + len(rows)] = np.square(rows) @ X.astype(rows.dtype)
+        sums = X.sum(axis=0)
+        Y -= np.outer(means, sums)
+        Y -= means @ X
+        Y += grand_mean * sums
+        return -0.5 * Y
+
+    B = LinearOperator( (n, n), matvec = matmat, matmat = matmat, rmatvec = matmat,
+                rmatmat = matmat, dtype = np.float64 )
+    # diagonal of B is means - grand_mean / 2
+    return B, float(n * grand_mean / 2)
+
+
+def top_eigen( B, k, method = 'eigsh', seed = None, oversampling = 10, power_iter = 4 ):
+    """ return (values, vectors) of the k largest eigenvalues of symmetric B,
+        in descending order
+    """
+    n = B.shape[0]
+    k = min(k, n)
+    if method == 'eigsh' and k < n - 1:
+        values, vectors = eigsh( B, k = k, which = 'LA' )
+    elif method in ('eigsh', 'randomized'):
+        # randomized range finder with power iterations (Halko et al. 2011)
+        rng = np.random.default_rng(seed)
+        Q = rng.standard_normal( (n, min(n, k + oversampling)) ).astype(B.dtype)
+        for _ in range(power_iter):
+            Q, _ = np.linalg.qr( B @ Q )
+        values, small = np.linalg.eigh( Q.T @ (B @ Q) )
+        vectors = Q @ small
+    else:
+        raise RuntimeError('unknown eigensolver method: %s' % method)
 
-    return (pcar, pcan.d)
+    order = np.argsort(values)[::-1][:k]
+    return (values[order].astype(np.float64), vectors[:, order].astype(np.float64))
 
 
 def plot_pca( pca_result, distance_matrix, pc1, pc2, filename=None, marker='+', size=30, alpha=0.75 ):
@@ -77,48 +166,227 @@ def plot_pca( pca_result, distance_matrix, pc1, pc2, filename=None, marker='+',
     return filename
 
 
-def mca( distance_matrix, dim = 2 ):
-    """ calculate MCA matrix using R's FactorMineR """
+def mca( distance_matrix, dim = 2, seed = 0 ):
+    """ calculate MCA coordinates of samples, ie. correspondence analysis of
+        the sparse indicator matrix Z of the calls, with truncated SVD of
+        S = Dr^-1/2 (Z/N - r c^T) Dc^-1/2; the row principal coordinates
+        are Dr^-1/2 U Sigma, as individual coordinates of FactoMineR's MCA
+    """
+
+    Z, _ = indicator_matrix( distance_matrix.G.calls )
+    N = Z.sum()
+    r = np.asarray( Z.sum(axis=1) ).ravel() / N
+    c = np.asarray( Z.sum(axis=0) ).ravel() / N
+    sr, sc = np.sqrt(r), np.sqrt(c)
 
-    # build up haplotype dataframe
+    # scale Z in place to Dr^-1/2 Z/N Dc^-1/2
+    Z.data = Z.data.astype(np.float64)
+    Z.data /= N
+    Z.data /= np.repeat( sr, np.diff(Z.indptr) )
+    Z.data /= sc[Z.indices]
 
-    from fatools.lib.utils import acquire_R, release_R
-    from rpy2 import robjects
-    from rpy2.robjects import pandas2ri
+    U, sigma, _ = centred_svds( Z, sr, sc, dim, seed )
+    coord = U * sigma / sr[:, None]
 
-    acquire_R()
+    return (coord, None)
 
-    r_df = pandas2ri.py2ri(distance_matrix.H)
-    robjects.globalenv['haplo_data'] = r_df
-    marker_len = len(distance_matrix.H.columns)
-    arguments = ','.join('as.factor(haplo_data[,%d])' % x
-                    for x in range(1, marker_len + 1))
-    robjects.r('haplo_df <- data.frame(%s)' % arguments)
-    robjects.r('library(FactoMineR)')
-    mca_res = robjects.r('MCA(haplo_df, graph=FALSE)')
 
-    # get the individual coordinate
-    coord = pandas2ri.ri2py(mca_res.rx('ind')[0].rx('coord')[0])
+def indicator_matrix( calls, block = 1024 ):
+    """ return ( sparse samples x categories one-hot CSR matrix of call codes,
+        array of locus index of each column ); a column exists for each
+        (locus, call) observed, missing calls have no column
+    """
 
-    release_R()
+    n, l = calls.shape
+    present = np.zeros( (l, len(call_codes)), dtype=bool )
+    for i in range(0, n, block):
+        chunk = calls[i:i + block]
+        for code in range(len(call_codes)):
+            if code != missing_code:
+                present[:, code] |= (chunk == code).any(axis=0)
 
-    return (coord, None)
+    Z = onehot_calls( calls, indicator_columns(present), block )
+    return (Z, np.nonzero(present)[0])
 
 
-def pca( distance_matrix, dim = 2 ):
+def indicator_columns( present ):
+    """ return loci x call codes array of the column of each (locus, call)
+        marked in boolean array present, ordered by locus then by call code;
+        missing and unmarked calls have column -1
+    """
+    present = present.copy()
+    present[:, missing_code] = False
+    column = np.full( present.shape, -1, dtype=np.int32 )
+    column[present] = np.arange( present.sum(), dtype=np.int32 )
+    return column
+
+
+def onehot_calls( calls, column, block = 1024 ):
+    """ return sparse float32 samples x columns one-hot CSR matrix of call
+        codes, with the column of each (locus, call) from indicator_columns();
+        calls without column are all zeros; calls are read by blocks of rows of
+        at most 4M calls
+    """
+
+    n, l = calls.shape
+    block = max( 1, min(block, (1 << 22) // max(l, 1)) )
+    indices, counts = [], []
+    for i in range(0, n, block):
+        chunk = calls[i:i + block]
+        rows, loci = np.nonzero( chunk != missing_code )
+        cols = column[loci, chunk[rows, loci]]
+        mapped = cols >= 0
+        indices.append( cols[mapped] )
+        counts.append( np.bincount(rows[mapped], minlength=len(chunk)) )
+    indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int32)
+    indptr = np.zeros( n + 1, dtype=np.int64 )
+    if counts:
+        np.cumsum( np.concatenate(counts), out=indptr[1:] )
+
+    return csr_matrix( (np.ones(len(indices), dtype=np.float32), indices, indptr),
+                    shape = (n, int((column >= 0).sum())) )
+
+
+def centred_svds( A, u, v, k, seed = 0 ):
+    """ return (U, sigma, Vt) of the k largest singular values of A - u v^T,
+        with sparse A, without densifying A
+    """
+
+    n, m = A.shape
+    if k >= min(n, m) - 1:
+        S = A.toarray().astype(np.float64) - np.outer(u, v)
+        U, sigma, Vt = np.linalg.svd( S, full_matrices=False )
+        return (U[:, :k], sigma[:k], Vt[:k])
+
+    def matmat(X):
+        X = X.reshape(m, -1)
+        return A @ X - np.outer(u, v @ X)
+
+    def rmatmat(Y):
+        Y = Y.reshape(n, -1)
+        return A.T @ Y - np.outer(v, u @ Y)
+
+    op = LinearOperator( (n, m), dtype = np.float64, matvec = matmat, matmat = matmat,
+                rmatvec = rmatmat, rmatmat = rmatmat )
+    v0 = np.random.default_rng(seed).standard_normal( min(n, m) )
+    U, sigma, Vt = svds( op, k = k, v0 = v0 )
+    order = np.argsort(sigma)[::-1]
+    return (U[:, order], sigma[order], Vt[order])
+
+
+def pca( distance_matrix, dim = 2, seed = 0 ):
     """ calculate PCA matrix using in-house algorithm, treating variables
-        as categorical data
+        as categorical data, ie. PCA of the column-centred sparse one-hot
+        indicator matrix, which is never densified
+        return: (samples x dim scores, percentage of variance of each axis)
     """
 
-    D = {}
+    Z, _ = indicator_matrix( distance_matrix.G.calls )
+    n = Z.shape[0]
+    means = np.asarray( Z.mean(axis=0, dtype=np.float64) ).ravel()
 
-    for c in distance_matrix.H.columns:
-        D[c] = pandas.get_dummies( distance_matrix.H[c])
+    U, sigma, _ = centred_svds( Z, np.ones(n), means, dim, seed )
 
-    #H = pandas.concat()
+    # total variance of the binary columns
+    total = n * (means * (1 - means)).sum()
+    variance = sigma ** 2 / total * 100 if total > 0 else sigma ** 2
+    return (U * sigma, variance)
+
+
+class IncrementalPCA(object):
+    """ streaming PCA fitted by chunks of samples with partial_fit(), keeping
+        only the mean and the first dim + oversampling components (Ross et al.
+        2008), hence memory does not depend on the number of samples; the
+        extra components reduce the truncation error of the first dim ones
+    """
 
-    # this function hasn't been finished yet
-    raise NotImplementedError
+    def __init__(self, dim = 2, oversampling = 20):
+        self.dim = dim
+        self.rank = dim + oversampling
+        self.n_samples = 0
+        self.mean = None
+        self.components = None
+        self.singular_values = None
+        self._sum_squares = None
+
+
+    def partial_fit(self, X):
+        """ update the components with chunk X of samples x features, dense or
+            sparse; the SVD of the stacked previous components, centred chunk
+            and shift of the mean is obtained from its Gram matrix, hence the
+            centred chunk is never materialized
+        """
+        if not issparse(X):
+            X = np.asarray(X)
+        n_new, m = X.shape
+        if n_new == 0:
+            return self
+        batch_mean = np.asarray( X.mean(axis=0, dtype=np.float64) ).ravel()
+        n_total = self.n_samples + n_new
+
+        if self.n_samples == 0:
+            self.mean = np.zeros(m)
+            self._sum_squares = np.zeros(m)
+            D = np.zeros( (0, m) )
+        else:
+            # the previous components and the shift of the mean
+            correction = np.sqrt( self.n_samples * n_new / n_total ) * (self.mean - batch_mean)
+            D = np.vstack( [ self.singular_values[:, None] * self.components, correction ] )
+
+        # Gram matrix of the rows of [ D ; X - batch_mean ]
+        k = len(D)
+        XX = self._gram(X)
+        X_mean = X @ batch_mean
+        G = np.empty( (k + n_new, k + n_new) )
+        G[:k, :k] = D @ D.T
+        G[k:, :k] = X @ D.T - (D @ batch_mean)[None, :]
+        G[:k, k:] = G[k:, :k].T
+        G[k:, k:] = XX - X_mean[:, None] - X_mean[None, :] + batch_mean @ batch_mean
+
+        w, U = np.linalg.eigh(G)
+        order = np.argsort(w)[::-1][:self.rank]
+        S = np.sqrt( np.clip(w[order], 0, None) )
+        U = U[:, order]
+
+        # right singular vectors, V = U^T [ D ; X - batch_mean ] / S
+        V = U[:k].T @ D + np.asarray( X.T @ U[k:] ).T - np.outer( U[k:].sum(axis=0), batch_mean )
+        self.components = np.divide( V, S[:, None], out=np.zeros_like(V), where=S[:, None] > 0 )
+        self.singular_values = S
+        if issparse(X):
+            self._sum_squares += np.asarray( X.multiply(X).sum(axis=0) ).ravel()
+        else:
+            self._sum_squares += np.einsum( 'ij,ij->j', X, X, dtype=np.float64 )
+        self.mean = (self.mean * self.n_samples + batch_mean * n_new) / n_total
+        self.n_samples = n_total
+        return self
+
+
+    @staticmethod
+    def _gram(X, block = 8192):
+        """ return X . X^T, densifying sparse X by blocks of float32 columns """
+        if not issparse(X):
+            return X @ X.T
+        X = X.tocsc()
+        G = np.zeros( (X.shape[0], X.shape[0]) )
+        for j in range(0, X.shape[1], block):
+            B = X[:, j:j + block].toarray().astype(np.float32, copy=False)
+            G += B @ B.T
+        return G
+
+
+    def transform(self, X):
+        """ return samples x dim coordinates of chunk X, dense or sparse """
+        components = self.components[:self.dim]
+        return np.asarray( X @ components.T ) - self.mean @ components.T
+
+
+    @property
+    def explained_variance_ratio(self):
+        """ percentage of total variance of each component """
+        n = self.n_samples
+        total = (self._sum_squares - n * self.mean ** 2).sum()
+        values = self.singular_values[:self.dim] ** 2
+        return values / total * 100 if total > 0 else values
 
 
 def format_data(pca_res, dm):
@@ -1,18 +1,27 @@
 
-from pandas import DataFrame, pivot_table
+import numpy as np
+from pandas import DataFrame, Index, Series, pivot_table
+from spatools.lib.analytics.genotype import GenotypeMatrix, PackedGenotypeMatrix
+from spatools.lib.analytics.fws import within_host_diversity
 
 
 
 class AlleleDataFrame(object):
 
-    def __init__(self, dbh, sample_ids, marker_ids, params):
+    def __init__(self, dbh, sample_ids, marker_ids, params, df=None, genotype_matrix=None):
+        """ if df is not provided, the dataframe is fetched using dbh """
         self.sample_ids = sample_ids
         self.marker_ids = marker_ids
         self.params = params
-        self._df = dbh.get_allele_dataframe(self.sample_ids, self.marker_ids,
+        if df is None:
+            df = dbh.get_allele_dataframe(self.sample_ids, self.marker_ids,
                         self.params)
+        self._df = df
         self._dominant_df = None
 
+        # samples x loci matrix of call codes
+        self._genotype_matrix = genotype_matrix
+
         # grouped dataframe based on [ 'marker_id', 'value']
         self._group_df = None
         self._group_dominant_df = None
@@ -26,10 +35,13 @@ class AlleleDataFrame(object):
         self._mlgt_df = None
         self._unique_mlgt_df = None
 
-        # moi
+        # moi and within-host diversity from read depths
         self._allele_multiplicity = None
         self._sample_multiplicity = None
         self._locus_multiplicity = None
+        self._sample_heterozygosity = None
+        self._locus_heterozygosity = None
+        self._fws = None
 
 
     @property
@@ -37,6 +49,161 @@ class AlleleDataFrame(object):
         return self._df
 
 
+    @property
+    def genotype_matrix(self):
+        """ return GenotypeMatrix of samples x loci, or PackedGenotypeMatrix
+            if params.genotype_storage is 'packed'
+        """
+        if self._genotype_matrix is None:
+            matrix = GenotypeMatrix.from_dataframe(self.df,
+                        depths = self.params.genotype_depths)
+            if self.params.genotype_storage == 'packed':
+                matrix = PackedGenotypeMatrix.from_matrix(matrix)
+            self._genotype_matrix = matrix
+        return self._genotype_matrix
+
+
+    def split(self, sample_id_sets):
+        """ return a list of AlleleDataFrame, one for each set of sample_ids,
+            whose dataframe and genotype matrix are views of contiguous row
+            blocks of this instance; rows of this instance are reordered by set
+        """
+
+        k = len(sample_id_sets)
+        set_ids = [ np.fromiter(ids, dtype=np.int64, count=len(ids)) for ids in sample_id_sets ]
+        set_index = np.repeat( np.arange(k), [ len(ids) for ids in set_ids ] )
+        pos = Index( np.concatenate(set_ids) if k else [] ).get_indexer(
+                        self._df['sample_id'].values )
+        group = np.where(pos >= 0, set_index[pos], k)
+
+        # rows of samples outside of all sets are moved to the end
+        order = np.argsort(group, kind='stable')
+        self._df = self._df.iloc[order].reset_index(drop=True)
+        self._dominant_df = None
+        bounds = np.searchsorted(group[order], np.arange(k + 1))
+
+        sample_ids = self._df['sample_id'].values
+        row_ids = [ np.unique(sample_ids[bounds[i]:bounds[i+1]]) for i in range(k) ]
+        row_bounds = np.cumsum( [0] + [ len(ids) for ids in row_ids ] )
+        row_ids = np.concatenate(row_ids) if k else np.zeros(0, dtype=np.int64)
+
+        # reuse existing genotype matrix (eg. from result cache) if its rows match
+        matrix = self._genotype_matrix
+        if matrix is None or not np.array_equal(matrix.sample_ids, row_ids):
+            matrix = GenotypeMatrix.from_dataframe(self._df, sample_ids = row_ids,
+                        depths = self.params.genotype_depths)
+            if self.params.genotype_storage == 'packed':
+                matrix = PackedGenotypeMatrix.from_matrix(matrix)
+        self._genotype_matrix = matrix
+
+        return [ self.__class__(None, sample_id_sets[i], self.marker_ids, self.params,
+                        df = self._df.iloc[bounds[i]:bounds[i+1]],
+                        genotype_matrix = matrix.row_slice(row_bounds[i], row_bounds[i+1]) )
+                    for i in range(k) ]
+
+
+    def filtered(self, sample_ids=None, marker_ids=None):
+        """ return a new AlleleDataFrame with only sample_ids and marker_ids,
+            masking rows of the dataframe and the genotype matrix
+        """
+        df = self._df
+        mask = np.ones(len(df), dtype=bool)
+        if sample_ids is not None:
+            mask &= np.isin( df['sample_id'].values, list(sample_ids) )
+        if marker_ids is not None:
+            mask &= np.isin( df['locus_id'].values, list(marker_ids) )
+        df = df[mask]
+
+        matrix = None
+        if self._genotype_matrix is not None:
+            matrix = self._genotype_matrix.take(
+                        sample_ids = np.unique( df['sample_id'].values ),
+                        locus_ids = marker_ids )
+
+        return self.__class__(None,
+                    sample_ids if sample_ids is not None else self.sample_ids,
+                    marker_ids if marker_ids is not None else self.marker_ids,
+                    self.params, df = df, genotype_matrix = matrix )
+
+
+    @property
+    def depths(self):
+        """ return int32 array of (samples x loci x 4) read counts of A, C, G, T
+            in the order of the genotype matrix
+        """
+        matrix = self.genotype_matrix
+        depths = getattr(matrix, 'depths', None)
+        if depths is None:
+            depths = GenotypeMatrix.from_dataframe(self.df, sample_ids = matrix.sample_ids,
+                        locus_ids = matrix.locus_ids, depths = True).depths
+        return depths
+
+
+    def _calculate_within_host_diversity(self):
+        matrix = self.genotype_matrix
+        d = within_host_diversity( self.depths,
+                    abs_threshold = self.params.abs_threshold,
+                    rel_threshold = getattr(self.params, 'rel_threshold', 0.0) )
+        sample_index = Index(matrix.sample_ids, name='sample_id')
+        locus_index = Index(matrix.locus_ids, name='marker_id')
+        self._allele_multiplicity = DataFrame( d['allele_multiplicity'],
+                    index = sample_index, columns = locus_index )
+        self._sample_multiplicity = Series( d['sample_multiplicity'], index = sample_index )
+        self._locus_multiplicity = DataFrame( d['locus_multiplicity'],
+                    index = sample_index, columns = locus_index )
+        self._sample_heterozygosity = Series( d['sample_heterozygosity'], index = sample_index )
+        self._locus_heterozygosity = Series( d['locus_heterozygosity'], index = locus_index )
+        self._fws = Series( d['fws'], index = sample_index )
+
+
+    @property
+    def allele_multiplicity(self):
+        """ return dataframe of samples x loci number of alleles called from read depths """
+        if self._allele_multiplicity is None:
+            self._calculate_within_host_diversity()
+        return self._allele_multiplicity
+
+
+    @property
+    def sample_multiplicity(self):
+        """ return series of MoI of each sample, ie. its highest allele multiplicity """
+        if self._sample_multiplicity is None:
+            self._calculate_within_host_diversity()
+        return self._sample_multiplicity
+
+
+    @property
+    def locus_multiplicity(self):
+        """ return dataframe of samples x loci, 1 for polyclonal locus of the sample """
+        if self._locus_multiplicity is None:
+            self._calculate_within_host_diversity()
+        return self._locus_multiplicity
+
+
+    @property
+    def sample_heterozygosity(self):
+        """ return series of mean within-host heterozygosity of each sample """
+        if self._sample_heterozygosity is None:
+            self._calculate_within_host_diversity()
+        return self._sample_heterozygosity
+
+
+    @property
+    def locus_heterozygosity(self):
+        """ return series of population heterozygosity of each locus """
+        if self._locus_heterozygosity is None:
+            self._calculate_within_host_diversity()
+        return self._locus_heterozygosity
+
+
+    @property
+    def fws(self):
+        """ return series of Fws of each sample """
+        if self._fws is None:
+            self._calculate_within_host_diversity()
+        return self._fws
+
+
     @property
     def dominant_df(self):
         """ return Pandas dataframe of (marker_id, sample_id, value, size, height) """
@@ -2,88 +2,706 @@
 #
 #
 
+import os, time
 import numpy as np
+from pandas import Index
+from multiprocessing import get_context, shared_memory
+from spatools.lib.analytics.genotype import ( GenotypeMatrix, PackedGenotypeMatrix,
+                    call_codes, encode_calls, missing_code )
+from spatools.lib.utils import cerr, cverr, random_string
 
-def null_distance( genotable ):
+
+# distance metrics
+#
+# a metric is a function of ( genotable, workers = 1, condensed = False )
+# returning (matrix, values), registered by name so that it can be selected
+# with 'distance_metric' in the query options; only metrics registered as
+# parallel make use of workers
+
+distance_metrics = {}
+
+def register_metric( name, requires_depths = False, parallel = False ):
+    """ decorator to register a distance metric; requires_depths marks metrics
+        that need GenotypeMatrix with read counts, parallel marks metrics that
+        compute in a process pool with workers > 1
+    """
+    def decorator( func ):
+        func.requires_depths = requires_depths
+        func.parallel = parallel
+        distance_metrics[name] = func
+        return func
+    return decorator
+
+
+def get_metric( name ):
+    try:
+        return distance_metrics[name]
+    except KeyError:
+        raise RuntimeError('unknown distance metric: %s' % name)
+
+
+def get_distance_function( options ):
+    """ return the distance metric set as 'distance_metric' in query options """
+    return get_metric( (options or {}).get('distance_metric', 'simple') )
+
+
+@register_metric('null')
+def null_distance( genotable, **kwargs ):
     """ return null distance, usable for the purpose of just building
         DistanceMatrix object with proper DataFrame
     """
     return (None, None)
 
-def simple_distance( genotable ):
-    """ return proportion of difference alleles """
+@register_metric('simple', parallel = True)
+def simple_distance( genotable, workers = 1, condensed = False ):
+    """ return proportion of difference alleles, ie. number of loci with
+        different calls in both genotyped samples divided by number of loci
+        genotable is either a (Packed)GenotypeMatrix or a dataframe of samples x loci
+        workers > 1 computes the distances in a process pool
+        condensed = True returns the distances as condensed float32 array
+        return: (samples x samples distance matrix, array of number of different
+                loci for each pair in upper triangle, diagonal included)
+    """
+
+    n, l = genotable.shape
+    if workers > 1:
+        v = parallel_mismatches( genotype_calls(genotable), workers )
+    else:
+        if isinstance(genotable, PackedGenotypeMatrix):
+            # popcount over the packed calls
+            mismatches, _ = genotable.hamming()
+        else:
+            mismatches, _ = pairwise_counts( genotype_calls(genotable) )
+        if not condensed:
+            return (mismatches / l, condense(mismatches))
+        v = condense(mismatches)
+
+    if condensed:
+        return ((v / np.float32(l)).astype(np.float32), v)
+    return (squareform(v, n) / l, v)
+
+
+def genotype_calls( genotable ):
+    """ return uint8 samples x loci call codes of GenotypeMatrix or dataframe """
+    if isinstance(genotable, (GenotypeMatrix, PackedGenotypeMatrix)):
+        return genotable.calls
+    values = genotable.values
+    return encode_calls( values.ravel() ).reshape(values.shape)
+
+
+def pairwise_counts( calls, tile = 2048 ):
+    """ return (mismatches, comparables) samples x samples matrices of number of
+        loci with different calls and number of loci genotyped in both samples
+
+        each call code is one-hot encoded as float32 samples x loci matrix X, so
+        that matches = sum of X . X^T and comparables = V . V^T, with V as the
+        genotyped mask; products are done in row tiles of the upper triangle
+    """
+
+    n = len(calls)
+    valid = calls != missing_code
+    comparables = _tiled_gram( valid.astype(np.float32), tile )
+    matches = np.zeros( (n, n), dtype=np.float32 )
+    for code in np.unique(calls):
+        if code == missing_code:
+            continue
+        matches += _tiled_gram( (calls == code).astype(np.float32), tile )
+
+    comparables = np.rint(comparables).astype(np.int64)
+    mismatches = comparables - np.rint(matches).astype(np.int64)
+    return (mismatches, comparables)
+
+
+def _tiled_gram( X, tile, Y = None ):
+    """ return X . X^T, computing upper triangle by row tiles,
+        or X . Y^T by row tiles if Y is given
+    """
+    n = len(X)
+    G = np.zeros( (n, n), dtype=np.float32 )
+    if Y is not None:
+        for i in range(0, n, tile):
+            G[i:i + tile] = X[i:i + tile] @ Y.T
+        return G
+    for i in range(0, n, tile):
+        I = slice(i, min(n, i + tile))
+        G[I, i:] = X[I] @ X[i:].T
+    mirror_upper(G, tile)
+    return G
+
+
+def mirror_upper( G, tile = 1024 ):
+    """ copy the upper triangle of square matrix G into its lower triangle in
+        place, tile by tile to avoid building triangle index arrays
+    """
+    n = len(G)
+    for i in range(0, n, tile):
+        I = slice(i, min(n, i + tile))
+        for j in range(i + tile, n, tile):
+            J = slice(j, min(n, j + tile))
+            G[J, I] = G[I, J].T
+        D = G[I, I]
+        D[:] = np.triu(D) + np.triu(D, 1).T
+
+
+def _distance_result( D, condensed ):
+    """ return (matrix, values) of square distance matrix D """
+    v = condense(D)
+    if condensed:
+        return (v.astype(np.float32), v)
+    return (D, v)
+
+
+def _proportion( numerator, denominator ):
+    """ return numerator / denominator, with 1.0 (maximal distance) for pairs
+        without comparable loci
+    """
+    D = np.ones( numerator.shape, dtype=np.float64 )
+    np.divide( numerator, denominator, out=D, where = denominator > 0 )
+    return D
+
+
+@register_metric('pairwise')
+def pairwise_deletion_distance( genotable, workers = 1, condensed = False, tile = 2048 ):
+    """ return proportion of different calls among loci genotyped in both
+        samples, ie. missing calls are deleted pairwise
+    """
+    mismatches, comparables = pairwise_counts( genotype_calls(genotable), tile )
+    return _distance_result( _proportion(mismatches, comparables), condensed )
+
+
+@register_metric('ibs')
+def ibs_distance( genotable, workers = 1, condensed = False, tile = 2048 ):
+    """ return 1 - identity by state among loci genotyped in both samples,
+        with a mixed (N) call sharing half state with any other call
+    """
+    calls = genotype_calls(genotable)
+    mismatches, comparables = pairwise_counts( calls, tile )
+    mixed = calls == call_codes.index('N')
+    single = ~mixed & (calls != missing_code)
+    half = _tiled_gram( mixed.astype(np.float32), tile, single.astype(np.float32) )
+    half += half.T
+    return _distance_result( _proportion(mismatches - 0.5 * half, comparables), condensed )
+
+
+@register_metric('weighted')
+def weighted_distance( genotable, workers = 1, condensed = False, tile = 2048 ):
+    """ return proportion of different calls among loci genotyped in both samples,
+        with each locus weighted by its expected heterozygosity 1 - sum(p^2),
+        hence loci with rare alleles and monomorphic loci weigh less
+    """
+    calls = genotype_calls(genotable)
+    valid = (calls != missing_code).astype(np.float32)
+    codes = [ c for c in np.unique(calls) if c != missing_code ]
+
+    genotyped = np.maximum(valid.sum(0), 1)
+    weights = np.ones( calls.shape[1], dtype=np.float32 )
+    for code in codes:
+        weights -= ( (calls == code).sum(0) / genotyped ) ** 2
+
+    comparables = _tiled_gram( valid * weights, tile, valid )
+    matches = np.zeros_like(comparables)
+    for code in codes:
+        X = (calls == code).astype(np.float32)
+        matches += _tiled_gram( X * weights, tile, X )
+    return _distance_result( _proportion(comparables - matches, comparables), condensed )
+
+
+@register_metric('depth', requires_depths = True)
+def depth_distance( genotable, workers = 1, condensed = False, tile = 2048 ):
+    """ return mean distance between read fractions of A, C, G, T among loci
+        genotyped in both samples; the distance at each locus is half of the
+        squared euclidean distance of the fractions, ie. 0 for identical and 1
+        for different single alleles, and in between for mixed infections
+    """
+    depths = getattr(genotable, 'depths', None)
+    if depths is None:
+        raise RuntimeError('depth distance requires GenotypeMatrix with depths, '
+                    'set genotype_depths in filter')
+
+    # bases outside of REF/ALT of VCF are stored with depth -1
+    depths = np.maximum(depths, 0)
+    n, l = genotable.shape
+    total = depths.sum(-1)
+    valid = (genotable.calls != missing_code) & (total > 0)
+    F = np.zeros( depths.shape, dtype=np.float32 )
+    np.divide( depths, total[..., None], out=F, where = valid[..., None] )
+    Q = (F ** 2).sum(-1)
+    V = valid.astype(np.float32)
+
+    # sum of (|f_i|^2 + |f_j|^2 - 2 f_i . f_j) / 2 over loci in both samples
+    comparables = _tiled_gram( V, tile )
+    QV = _tiled_gram( Q, tile, V )
+    F = F.reshape( (n, l * 4) )
+    cross = _tiled_gram( F, tile )
+    D = _proportion( np.maximum(0.5 * (QV + QV.T) - cross, 0), comparables )
+    return _distance_result( D, condensed )
+
 
-    n = len(genotable)
-    m = np.zeros( (n,n) )
-    g = genotable.values
-    v = []
-    l = len(g[0])
+def benchmark_metrics( n = 1000, l = 500, metrics = None, seed = None ):
+    """ return dict of { metric_name: seconds } of computing each metric on
+        random n x l genotype matrix with 10% missing calls and random depths
+    """
+    rng = np.random.default_rng(seed)
+    calls = rng.choice( np.arange(6, dtype=np.uint8), size=(n, l),
+                        p = [0.1, 0.3, 0.3, 0.1, 0.1, 0.1] )
+    depths = rng.poisson( 20, size=(n, l, 4) ).astype(np.int32)
+    matrix = GenotypeMatrix( calls, np.arange(n), np.arange(l), depths )
+
+    timings = {}
+    for name in (metrics or distance_metrics):
+        start = time.perf_counter()
+        get_metric(name)( matrix )
+        timings[name] = time.perf_counter() - start
+        cverr(1, 'INFO: metric %s on %d x %d: %.3f s' % (name, n, l, timings[name]))
+    return timings
+
+
+# parallel computation
+#
+# the call codes are copied once into a shared memory block, and the upper
+# triangle is split into tiles of rows x columns which are computed by a
+# process pool; each worker writes its mismatch counts directly into the
+# shared condensed output, ie. the upper triangle (diagonal included) in
+# row-major order.
+
+_shared = {}
+
+def condensed_offset( i, n ):
+    """ return the position of (i, i) in condensed upper triangle of n x n matrix """
+    return i * n - i * (i - 1) // 2
+
+
+def squareform( v, n, dtype = np.float64 ):
+    """ return n x n symmetric matrix of condensed upper triangle v """
+    M = np.zeros( (n, n), dtype=dtype )
+    for i in range(n):
+        start = condensed_offset(i, n)
+        M[i, i:] = v[start : start + n - i]
+    mirror_upper(M)
+    return M
+
+
+def condense( M ):
+    """ return condensed upper triangle of square matrix M """
+    n = len(M)
+    v = np.empty( n * (n + 1) // 2, dtype=M.dtype )
+    for i in range(n):
+        start = condensed_offset(i, n)
+        v[start : start + n - i] = M[i, i:]
+    return v
+
+
+def condensed_row( v, i, n ):
+    """ return row i of n x n symmetric matrix stored as condensed v """
+    row = np.empty( n, dtype=v.dtype )
+    # left of the diagonal is read down column i of the upper triangle
+    j = np.arange(i)
+    row[:i] = v[ condensed_offset(j, n) + i - j ]
+    start = condensed_offset(i, n)
+    row[i:] = v[start : start + n - i]
+    return row
+
+
+def parallel_mismatches( calls, workers, tile = 1024 ):
+    """ return condensed int32 array of number of loci with different calls,
+        computed by workers processes
+    """
 
-    for i in range(0, n):
-        for j in range(i, n):
-            d = sum( 1 if x != y else 0 for (x,y) in zip( g[i], g[j]) )
-            m[i,j] = m[j,i] = d/l
-            v.append( d )
+    n, l = calls.shape
+    size = n * (n + 1) // 2
+    codes = [ int(c) for c in np.unique(calls) if c != missing_code ]
+    tiles = [ (i, min(n, i + tile), j, min(n, j + tile))
+                for i in range(0, n, tile) for j in range(i, n, tile) ]
 
-    return (m, v)
+    shm_calls = shared_memory.SharedMemory(create=True, size=max(1, calls.nbytes))
+    shm_out = shared_memory.SharedMemory(create=True, size=max(1, size * 4))
+    try:
+        np.ndarray(calls.shape, dtype=np.uint8, buffer=shm_calls.buf)[:] = calls
+        with get_context().Pool( workers, initializer = _attach_shared,
+                    initargs = (shm_calls.name, (n, l), shm_out.name, size, codes) ) as pool:
+            for _ in pool.imap_unordered(_compute_tile, tiles):
+                pass
+        return np.ndarray( (size,), dtype=np.int32, buffer=shm_out.buf ).copy()
+    finally:
+        for shm in (shm_calls, shm_out):
+            shm.close()
+            shm.unlink()
+
+
+def tile_mismatches( R, C, codes ):
+    """ return float32 rows x columns matrix of number of loci with different
+        calls between call codes R and C
+    """
+    counts = ( (R != missing_code).astype(np.float32)
+                @ (C != missing_code).astype(np.float32).T )
+    for code in codes:
+        counts -= (R == code).astype(np.float32) @ (C == code).astype(np.float32).T
+    return counts
+
+
+def _attach_shared( calls_name, shape, out_name, size, codes ):
+    """ pool initializer, attach the shared blocks in the worker process """
+    shm_calls = shared_memory.SharedMemory(name=calls_name)
+    shm_out = shared_memory.SharedMemory(name=out_name)
+    _shared['shm'] = (shm_calls, shm_out)
+    _shared['calls'] = np.ndarray(shape, dtype=np.uint8, buffer=shm_calls.buf)
+    _shared['out'] = np.ndarray( (size,), dtype=np.int32, buffer=shm_out.buf )
+    _shared['codes'] = codes
+
+
+def _compute_tile( tile ):
+    """ count mismatches of rows [i0, i1) against columns [j0, j1) """
+
+    i0, i1, j0, j1 = tile
+    calls, out = _shared['calls'], _shared['out']
+    n = len(calls)
+    counts = tile_mismatches( calls[i0:i1], calls[j0:j1], _shared['codes'] )
+    counts = np.rint(counts).astype(np.int32)
+
+    # each row of the tile is a contiguous run in the condensed output
+    for i in range(i0, i1):
+        j = max(i, j0)
+        if j >= j1:
+            continue
+        start = condensed_offset(i, n) + j - i
+        out[start : start + j1 - j] = counts[i - i0, j - j0:]
+
+
+# incremental computation
+#
+# the condensed distances are saved along with the sample ids and locus ids
+# they were computed on.  When the locus set is unchanged, only the distances
+# of the new samples against all samples are computed, and the distances
+# between previous samples are copied from the saved matrix.
+
+def save_distance( path, distances, sample_ids, locus_ids, metric ):
+    """ save condensed distances as .npz file """
+    tmp_file = '%s.%s.npz' % (path, random_string(6))
+    with open(tmp_file, 'wb') as f:
+        np.savez( f, distances = np.asarray(distances, dtype=np.float32),
+                    sample_ids = np.asarray(sample_ids), locus_ids = np.asarray(locus_ids),
+                    metric = np.array(metric) )
+    os.replace(tmp_file, path)
+
+
+def load_distance( path ):
+    """ return dict of saved distances, or None if path does not exist """
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle=False) as data:
+        return { k: data[k] for k in data.files }
+
+
+def incremental_distance( calls, sample_ids, previous, block = 1024 ):
+    """ return (condensed float32 simple distance, condensed int32 number of
+        different loci) of call codes, copying the values between samples found
+        in previous (as returned by load_distance()) and computing the rows of
+        new samples only
+    """
+
+    n, l = calls.shape
+    prev_n = len(previous['sample_ids'])
+    prev_D = previous['distances']
+    positions = { sid: i for i, sid in enumerate(previous['sample_ids'].tolist()) }
+    prev_pos = np.array( [ positions.get(sid, -1) for sid in sample_ids ], dtype=np.int64 )
+    new_idx = np.flatnonzero(prev_pos < 0)
+    cverr(1, 'INFO: computing distances of %d new samples against %d samples'
+                % (len(new_idx), n))
+
+    codes = [ int(c) for c in np.unique(calls) if c != missing_code ]
+    new_rows = np.empty( (len(new_idx), n), dtype=np.int32 )
+    for i in range(0, len(new_idx), block):
+        I = new_idx[i:i + block]
+        new_rows[i:i + len(I)] = np.rint( tile_mismatches(calls[I], calls, codes) )
+    new_row_of = np.full( n, -1, dtype=np.int64 )
+    new_row_of[new_idx] = np.arange(len(new_idx))
+
+    # saved distances are mismatches / l, hence the counts are recovered exactly
+    mismatches = np.empty( n * (n + 1) // 2, dtype=np.int32 )
+    for i in range(n):
+        if new_row_of[i] >= 0:
+            row = new_rows[new_row_of[i], i:]
+        else:
+            pos = prev_pos[i:]
+            row = np.rint( condensed_row(prev_D, prev_pos[i], prev_n)[pos]
+                        * np.float64(l) ).astype(np.int32)
+            new_cols = pos < 0
+            row[new_cols] = new_rows[new_row_of[i:][new_cols], i]
+        start = condensed_offset(i, n)
+        mismatches[start : start + n - i] = row
+    return ((mismatches / np.float32(l)).astype(np.float32), mismatches)
 
 
 class DistanceMatrix(object):
     """ this class holds distance matrix result
+
+        storage is either 'dense' (samples x samples float64 matrix M) or
+        'condensed' (float32 upper triangle, optionally memory-mapped to
+        mmap_file as .npy); use row(), rows() and square() to access the
+        distances regardless of the storage
     """
 
-    def __init__(self, haplotype_sets):
+    block_size = 1024
+
+    def __init__(self, haplotype_sets, storage = 'dense', mmap_file = None):
+        if storage not in ('dense', 'condensed'):
+            raise RuntimeError('unknown distance matrix storage: %s' % storage)
         self._haplotype_sets = haplotype_sets
-        self.H = None   # haplotypes as pandas DataFrame
-        self.M = None   # the distance matrix
+        self.storage = storage
+        self.mmap_file = mmap_file
+        self.G = None   # haplotypes as stacked GenotypeMatrix
+        self._H = None  # haplotypes as pandas DataFrame, built on demand
+        self._M = None  # the distance matrix, square or condensed
         self.S = None   # set index, containing (haplo_set, start, length)
-        self.V = None   # array of all distance values
+        self.V = None   # array of all distance values (dense storage only)
         self.I = None   # sample_id for each samples (useful for NJ)
         self.C = None   # color for each samples (useful for NJ)
         self.L = None   # label for each samples (useful for data output)
 
 
-    def calculate_distance(self, dfunc):
+    def calculate_distance(self, dfunc, workers = 1, incremental = None):
+        """ incremental is the path of .npz file of previously saved distances,
+            which is reused if computed with the same function on the same loci,
+            and is updated with the new distances
+        """
+
+        self.stack_haplotypes()
+        locus_ids = self.G.locus_ids.tolist()
+
+        if incremental:
+            previous = load_distance(incremental)
+            if ( previous is not None and dfunc is simple_distance
+                    and str(previous['metric']) == dfunc.__name__
+                    and previous['locus_ids'].tolist() == locus_ids ):
+                D, v = incremental_distance( self.G.calls, self.G.sample_ids.tolist(),
+                            previous )
+                if self.storage == 'condensed':
+                    self.set_distance( D, v )
+                else:
+                    self.set_distance( squareform(v, self.G.N) / len(locus_ids), v )
+                save_distance( incremental, D, self.G.sample_ids, locus_ids,
+                            dfunc.__name__ )
+                return
+            cverr(1, 'INFO: previous distances are not reusable, computing all distances')
+
+        kwargs = {}
+        if workers > 1:
+            if getattr(dfunc, 'parallel', False):
+                kwargs['workers'] = workers
+            else:
+                cerr('WARN: distance function %s has no parallel computation, '
+                        'using a single process' % dfunc.__name__)
+        if self.storage == 'condensed':
+            kwargs['condensed'] = True
+        self.set_distance( *dfunc(self.G, **kwargs) )
+
+        if incremental and self._M is not None:
+            save_distance( incremental, self.condensed(), self.G.sample_ids, locus_ids,
+                            dfunc.__name__ )
+
+
+    def stack_haplotypes(self):
+        """ stack genotype matrices of all haplotype sets once into a single
+            GenotypeMatrix, with (haplo_set, start, length) offsets in S;
+            the stacked matrix is a PackedGenotypeMatrix if all sets are packed
+        """
+
+        sets = [ hs for hs in self._haplotype_sets if hs.N > 0 ]
+        matrices = [ hs.genotype_matrix for hs in sets ]
+        if not matrices:
+            raise RuntimeError('no samples in haplotype sets')
+        sizes = [ m.N for m in matrices ]
+        offsets = np.cumsum( [0] + sizes )
+
+        packed = all( isinstance(m, PackedGenotypeMatrix) for m in matrices )
+        if packed and PackedGenotypeMatrix.same_coding(matrices):
+            # row slices of the same packed matrix, no need to unpack
+            self.G = PackedGenotypeMatrix.concatenate(matrices)
+        else:
+            self.G = self._stack_calls(matrices, offsets)
+            if packed:
+                self.G = PackedGenotypeMatrix.from_matrix(self.G)
+
+        sample_ids = self.G.sample_ids
+        self._H = None
+        self.S = [ (hs, int(start), size) for hs, start, size in zip(sets, offsets, sizes) ]
+        self.I = Index(sample_ids, name='sample_id')
+        self.C = [ hs.colour for hs in sets for _ in range(hs.N) ]
+        self.L = [ hs.label for hs in sets for _ in range(hs.N) ]
+
+
+    def _stack_calls(self, matrices, offsets):
+        """ return GenotypeMatrix of the calls of matrices, with the loci of
+            the first matrix
+        """
+
+        locus_ids = matrices[0].locus_ids
+        n = offsets[-1]
+
+        with_depths = all( getattr(m, 'depths', None) is not None for m in matrices )
+        calls = np.empty( (n, len(locus_ids)), dtype=np.uint8 )
+        sample_ids = np.empty( n, dtype=matrices[0].sample_ids.dtype )
+        depths = np.empty( (n, len(locus_ids), 4), dtype=np.int32 ) if with_depths else None
+
+        for m, start, stop in zip(matrices, offsets[:-1], offsets[1:]):
+            cols = slice(None)
+            if not np.array_equal(m.locus_ids, locus_ids):
+                cols = Index(m.locus_ids).get_indexer(locus_ids)
+                if (cols < 0).any() or len(m.locus_ids) != len(locus_ids):
+                    raise RuntimeError('haplotype sets have different loci')
+            calls[start:stop] = m.calls[:, cols]
+            sample_ids[start:stop] = m.sample_ids
+            if with_depths:
+                depths[start:stop] = m.depths[:, cols]
+
+        return GenotypeMatrix(calls, sample_ids, locus_ids, depths)
+
+
+    def set_matrix(self, idx):
+        """ return (Packed)GenotypeMatrix view of the idx-th haplotype set in S """
+        hs, start, size = self.S[idx]
+        return self.G.row_slice(start, start + size)
+
+
+    @property
+    def H(self):
+        """ haplotypes as pandas DataFrame of samples x loci """
+        if self._H is None and self.G is not None:
+            self._H = self.G.to_dataframe()
+        return self._H
+
+
+    def set_distance(self, m, v):
+        """ store result of distance function according to the storage """
+
+        if self.storage == 'dense' or m is None:
+            self._M = m
+            self.V = v
+            return
+
+        if self.mmap_file:
+            # square matrices are written row by row, without condensing in memory
+            n = len(m)
+            size = n * (n + 1) // 2 if m.ndim == 2 else len(m)
+            D = np.lib.format.open_memmap( self.mmap_file, mode='w+',
+                        dtype=np.float32, shape=(size,) )
+            if m.ndim == 2:
+                for i in range(n):
+                    start = condensed_offset(i, n)
+                    D[start : start + n - i] = m[i, i:]
+            else:
+                D[:] = m
+            D.flush()
+            m = D
+        elif m.ndim == 2:
+            m = condense(m)
+        self._M = m.astype(np.float32, copy=False)
+        self.V = None
+
+
+    @property
+    def M(self):
+        """ square distance matrix, materialized on demand for condensed storage """
+        if self.storage == 'condensed' and self._M is not None:
+            return self.square()
+        return self._M
+
+    @M.setter
+    def M(self, m):
+        self.set_distance(m, None)
+
+
+    @property
+    def n(self):
+        if self.storage == 'dense':
+            return len(self._M)
+        return int( (np.sqrt(8 * len(self._M) + 1) - 1) // 2 )
+
+
+    def row(self, i):
+        """ return distances of sample i to all samples """
+        if self.storage == 'dense':
+            return self._M[i]
+        return condensed_row(self._M, i, self.n)
+
+
+    def rows(self, start, stop, col_block = 4096):
+        """ return distances of samples [start, stop) to all samples """
+        if self.storage == 'dense':
+            return self._M[start:stop]
+
+        v, n = self._M, self.n
+        stop = min(stop, n)
+        out = np.empty( (stop - start, n), dtype=v.dtype )
+        # left of the block, D[i, j] = D[j, i] is contiguous in i for each j
+        i = np.arange(start, stop)
+        for c in range(0, start, col_block):
+            j = np.arange(c, min(start, c + col_block))
+            out[:, c:c + len(j)] = v[ condensed_offset(j, n)[None, :] + (i[:, None] - j[None, :]) ]
+        # right of the diagonal is a contiguous run of each row
+        for k in range(stop - start):
+            offset = condensed_offset(start + k, n)
+            out[k, start + k:] = v[offset : offset + n - start - k]
+        # mirror the upper triangle within the block
+        mirror_upper( out[:, start:stop] )
+        return out
+
+
+    def iter_blocks(self, block_size = None):
+        """ yield (start, rows) of consecutive blocks of rows """
+        block_size = block_size or self.block_size
+        for start in range(0, self.n, block_size):
+            yield (start, self.rows(start, start + block_size))
+
+
+    def square(self, dtype = np.float64):
+        """ return a new square matrix of the distances """
+        if self.storage == 'dense':
+            return self._M.astype(dtype)
+        return squareform(self._M, self.n, dtype)
+
+
+    def condensed(self):
+        """ return condensed upper triangle of the distances, diagonal included """
+        if self.storage == 'dense':
+            return condense(self._M)
+        return self._M
 
-        for idx, hs in enumerate(self._haplotype_sets):
-            if hs.N <= 0:
-                continue
-            if self.H is None:
-                self.S = [ (hs, 0, hs.N) ]
-                self.H = hs.variant_df
-                self.I = hs.variant_df.index
-                self.C = [ hs.colour ] * hs.N
-                self.L = [ hs.label ] * hs.N
-                continue
-            self.S.append( (hs, len(self.H), hs.N) )
-            self.H = self.H.append(hs.variant_df)
-            self.C += [ hs.colour ] * hs.N
-            self.L += [ hs.label ] * hs.N
-            self.I = self.I.append(hs.variant_df.index)
 
-        (m, v) = dfunc(self.H)
-        self.M = m
-        self.V = v
+    def write_matrix(self, outstream, fmt = '%2.3f'):
+        """ write tab-delimited distance matrix with header of sample_ids """
+        outstream.write( '\t'.join( str(x) for x in self.sample_ids ) )
+        outstream.write( '\n' )
+        for start, block in self.iter_blocks():
+            for name, vals in zip( self.sample_ids[start:start + len(block)], block ):
+                outstream.write( '%s\t%s\n' % (str(name), '\t'.join( [fmt % x for x in vals] ) ))
 
 
     @property
     def total_samples(self):
-        return len(self.H)
+        return self.G.N
 
 
     @property
     def sample_ids(self):
-        return self.H.index
+        return self.I
 
 
 
-def get_distance_matrix(haplotype_sets, dfunc = simple_distance):
+def get_distance_matrix(haplotype_sets, dfunc = simple_distance, workers = 1,
+            storage = 'dense', mmap_file = None, incremental = None):
     """ returning a distance matrix object
-        dfunc is a function that returns (matrix, values)
+        dfunc is a function that returns (matrix, values), or name of
+        registered distance metric
+        workers is the number of processes used to compute the distances
+        storage is 'dense' or 'condensed', see DistanceMatrix
+        incremental is the path of saved distances to be reused and updated
     """
 
-    dm = DistanceMatrix(haplotype_sets)
-    dm.calculate_distance( dfunc )
+    if isinstance(dfunc, str):
+        dfunc = get_metric(dfunc)
+    dm = DistanceMatrix(haplotype_sets, storage, mmap_file)
+    dm.calculate_distance( dfunc, workers, incremental )
 
     return dm
 
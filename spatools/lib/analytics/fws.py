@@ -0,0 +1,77 @@
+#
+# fws.py
+#
+# Within-host diversity from read depths
+# ======================================
+#
+# read counts of A, C, G, T of each sample at each locus are taken as
+# (samples x loci x 4) depth arrays.  A base is called as an allele of the
+# sample at the locus if its depth is above the absolute threshold and at
+# least the relative threshold of the depth of the major base:
+#
+#   allele multiplicity     number of alleles of sample at locus, 0 if no reads
+#   sample multiplicity     MoI of sample, ie. its highest allele multiplicity
+#   locus multiplicity      1 if the sample is polyclonal at the locus, else 0
+#
+# heterozygosities are calculated from the within-sample base frequencies q
+# of the called alleles:
+#
+#   Hw = 1 - sum(q^2)       within-host heterozygosity of sample at locus
+#   Hs = 1 - sum(p^2)       population heterozygosity of locus, p = mean of q
+#   Fws = 1 - sum(Hw)/sum(Hs)   over loci with reads in the sample
+#
+
+import numpy as np
+
+
+def called_alleles(depths, abs_threshold=0, rel_threshold=0.0):
+    """ return boolean (samples x loci x 4) array of bases called as alleles """
+    depths = np.asarray(depths)
+    major = depths.max(axis=-1, keepdims=True)
+    return (depths > max(abs_threshold, 0)) & (depths >= rel_threshold * major)
+
+
+def within_host_diversity(depths, abs_threshold=0, rel_threshold=0.0):
+    """ return dict of arrays:
+            allele_multiplicity: int (samples x loci)
+            sample_multiplicity: int (samples)
+            locus_multiplicity: int (samples x loci) of polyclonal loci
+            heterozygosity: float (samples x loci) Hw, NaN where no reads
+            sample_heterozygosity: float (samples) mean Hw
+            locus_heterozygosity: float (loci) Hs
+            fws: float (samples), NaN for samples without reads
+    """
+
+    called = called_alleles(depths, abs_threshold, rel_threshold)
+    allele_multiplicity = called.sum(axis=-1)
+    genotyped = allele_multiplicity > 0
+
+    # within-sample frequencies of called alleles
+    counts = np.where(called, depths, 0).astype(np.float64)
+    totals = counts.sum(axis=-1, keepdims=True)
+    q = np.divide(counts, totals, out=np.zeros_like(counts), where=totals > 0)
+
+    hw = 1.0 - (q**2).sum(axis=-1)
+    hw[~genotyped] = np.nan
+
+    n = genotyped.sum(axis=0)
+    p = np.divide(q.sum(axis=0), n[:, None], out=np.zeros(q.shape[1:]), where=n[:, None] > 0)
+    hs = 1.0 - (p**2).sum(axis=-1)
+    hs[n == 0] = np.nan
+
+    # sum of Hw and Hs over the loci with reads of each sample
+    sum_hw = np.where(genotyped, hw, 0.0).sum(axis=1)
+    sum_hs = genotyped @ np.nan_to_num(hs)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fws = np.where(sum_hs > 0, 1.0 - sum_hw / sum_hs, np.where(genotyped.any(1), 1.0, np.nan))
+        sample_heterozygosity = sum_hw / genotyped.sum(axis=1)
+
+    return {
+        'allele_multiplicity': allele_multiplicity,
+        'sample_multiplicity': allele_multiplicity.max(axis=1, initial=0),
+        'locus_multiplicity': (allele_multiplicity > 1).astype(int),
+        'heterozygosity': hw,
+        'sample_heterozygosity': sample_heterozygosity,
+        'locus_heterozygosity': hs,
+        'fws': fws,
+    }
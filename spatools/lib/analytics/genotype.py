@@ -0,0 +1,451 @@
+#
+# genotype.py
+#
+# Compact coding of base calls
+# ============================
+#
+# base calls are coded as uint8, with code 0 (X) as missing call:
+#
+#       X   A   C   G   T   N   -
+#       0   1   2   3   4   5   6
+#
+
+import numpy as np
+from pandas import Categorical, CategoricalDtype, DataFrame, Index, isna
+
+
+call_codes = 'XACGTN-'
+missing_code = 0
+
+_call_lut = np.full(256, call_codes.index('N'), dtype=np.uint8)
+for _code, _call in enumerate(call_codes):
+    _call_lut[ord(_call)] = _code
+    _call_lut[ord(_call.lower())] = _code
+_call_array = np.array(list(call_codes))
+
+
+def encode_calls(calls):
+    """ return uint8 array of codes from a sequence of single-character calls,
+        None, NaN or empty calls are coded as missing
+    """
+    calls = np.array(calls, dtype=object)
+    if len(calls) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    calls[isna(calls)] = 'X'
+    codes = _call_lut[ calls.astype('S1').view(np.uint8) ]
+    codes[ calls == '' ] = missing_code
+    return codes
+
+
+def decode_calls(codes):
+    """ return array of single-character calls from uint8 codes """
+    return _call_array[codes]
+
+
+def call_categorical(codes):
+    """ return pandas Categorical of calls from uint8 codes """
+    return Categorical.from_codes(codes, categories = list(call_codes))
+
+
+class GenotypeMatrix(object):
+    """ GenotypeMatrix
+
+        calls: uint8 array of (samples x loci) call codes, missing_code for missing call
+        sample_ids: array of sample_id for each row
+        locus_ids: array of locus_id for each column
+        depths: optional int32 array of (samples x loci x 4) read counts of A, C, G, T
+    """
+
+    def __init__(self, calls, sample_ids, locus_ids, depths=None):
+        assert calls.shape == (len(sample_ids), len(locus_ids))
+        self.calls = calls
+        self.sample_ids = np.asarray(sample_ids)
+        self.locus_ids = np.asarray(locus_ids)
+        self.depths = depths
+        self._missing = None
+
+
+    @classmethod
+    def from_dataframe(cls, df, sample_ids=None, locus_ids=None, depths=False):
+        """ build matrix from long-format allele dataframe, ie. rows of
+            ( locus_id, sample_id, call, A, C, G, T ); samples and loci not in
+            sample_ids and locus_ids are ignored; depths = True also keeps
+            the read counts of A, C, G, T
+        """
+        df_sample_ids = df['sample_id'].values
+        df_locus_ids = df['locus_id'].values
+
+        if sample_ids is None:
+            sample_ids, rows = np.unique(df_sample_ids, return_inverse=True)
+        else:
+            sample_ids = np.asarray(sample_ids)
+            rows = Index(sample_ids).get_indexer(df_sample_ids)
+
+        if locus_ids is None:
+            locus_ids, cols = np.unique(df_locus_ids, return_inverse=True)
+        else:
+            locus_ids = np.asarray(locus_ids)
+            cols = Index(locus_ids).get_indexer(df_locus_ids)
+
+        call = df['call']
+        if ( isinstance(call.dtype, CategoricalDtype)
+                and list(call.cat.categories) == list(call_codes) ):
+            codes = call.cat.codes.values.astype(np.uint8)
+        else:
+            codes = encode_calls(call.values)
+
+        calls = np.zeros( (len(sample_ids), len(locus_ids)), dtype=np.uint8 )
+        keep = (rows >= 0) & (cols >= 0)
+        calls[rows[keep], cols[keep]] = codes[keep]
+
+        if depths:
+            depths = np.zeros( calls.shape + (4,), dtype=np.int32 )
+            depths[rows[keep], cols[keep]] = np.stack(
+                        [ df[base].values[keep] for base in 'ACGT' ], axis=1 )
+        else:
+            depths = None
+
+        return cls(calls, sample_ids, locus_ids, depths)
+
+
+    @property
+    def shape(self):
+        return self.calls.shape
+
+
+    @property
+    def N(self):
+        return len(self.sample_ids)
+
+
+    @property
+    def L(self):
+        return len(self.locus_ids)
+
+
+    @property
+    def missing(self):
+        """ boolean mask of missing calls """
+        if self._missing is None:
+            self._missing = self.calls == missing_code
+        return self._missing
+
+
+    def row_slice(self, start, stop):
+        """ return a GenotypeMatrix view of rows [start:stop] """
+        matrix = self.__class__( self.calls[start:stop], self.sample_ids[start:stop],
+                    self.locus_ids,
+                    None if self.depths is None else self.depths[start:stop] )
+        if self._missing is not None:
+            matrix._missing = self._missing[start:stop]
+        return matrix
+
+
+    def take(self, sample_ids=None, locus_ids=None):
+        """ return a new GenotypeMatrix with only sample_ids and locus_ids,
+            in the order of this matrix
+        """
+        rows = slice(None) if sample_ids is None else np.isin(self.sample_ids, list(sample_ids))
+        cols = slice(None) if locus_ids is None else np.isin(self.locus_ids, list(locus_ids))
+        return self.__class__( self.calls[rows][:, cols],
+                    self.sample_ids[rows], self.locus_ids[cols],
+                    None if self.depths is None else self.depths[rows][:, cols] )
+
+
+    def to_dataframe(self):
+        """ return dataframe of calls with sample_id as index and locus_id as
+            columns, and NaN for missing calls
+        """
+        calls = decode_calls(self.calls).astype(object)
+        calls[self.missing] = np.nan
+        return DataFrame( calls,
+                    index = Index(self.sample_ids, name='sample_id'),
+                    columns = Index(self.locus_ids, name='locus_id') )
+
+
+    def genotyped_per_sample(self):
+        """ return array of number of genotyped loci for each sample """
+        return self.L - self.missing.sum(1)
+
+
+    def genotyped_per_locus(self):
+        """ return array of number of genotyped samples for each locus """
+        return self.N - self.missing.sum(0)
+
+
+#
+# 2-bit packed genotype matrix
+# ============================
+#
+# each locus has a table of up to 4 call codes (its alleles), and each call is
+# stored as 2-bit index into the table of its locus, 4 calls per byte, with
+# call j of a sample at bits 2*(j%4) of byte j//4.  Missing calls are stored
+# in a bitmap with call j at bit j%8 of byte j//8.  Loci with more than 4 call
+# codes are kept as dense uint8 columns.
+#
+
+_popcount_lut = np.array( [ bin(x).count('1') for x in range(256) ], dtype=np.uint8 )
+
+# spread bits 0-3 (lo) and 4-7 (hi) of a byte into the even bits of a byte
+_spread_lo = np.array( [ sum( ((x >> i) & 1) << (2*i) for i in range(4) )
+                            for x in range(256) ], dtype=np.uint8 )
+_spread_hi = _spread_lo[ np.arange(256) >> 4 ]
+
+
+def popcount(a):
+    """ return number of set bits of each element of uint8 array """
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(a)
+    return _popcount_lut[a]
+
+
+class PackedGenotypeMatrix(object):
+    """ PackedGenotypeMatrix
+
+        packed: uint8 array of (samples x ceil(loci/4)) 2-bit allele indexes
+        missing_bits: uint8 array of (samples x ceil(loci/8)) missing bitmap
+        alleles: uint8 array of (loci x 4) call codes for each allele index
+        dense_cols: column indexes of loci with more than 4 call codes
+        dense_calls: uint8 array of (samples x len(dense_cols)) call codes
+        depths: optional int32 array of (samples x loci x 4) read counts of A, C, G, T,
+                kept unpacked
+    """
+
+    block_size = 4096   # number of loci processed per block, multiple of 8
+
+    def __init__(self, packed, missing_bits, alleles, dense_cols, dense_calls,
+                    sample_ids, locus_ids, depths=None):
+        self.packed = packed
+        self.missing_bits = missing_bits
+        self.alleles = alleles
+        self.dense_cols = dense_cols
+        self.dense_calls = dense_calls
+        self.sample_ids = np.asarray(sample_ids)
+        self.locus_ids = np.asarray(locus_ids)
+        self.depths = depths
+
+
+    @classmethod
+    def from_matrix(cls, matrix):
+        """ pack a GenotypeMatrix, block by block of loci """
+
+        calls = matrix.calls
+        n, L = calls.shape
+        packed = np.zeros( (n, -(-L // 4)), dtype=np.uint8 )
+        missing_bits = np.zeros( (n, -(-L // 8)), dtype=np.uint8 )
+        alleles = np.zeros( (L, 4), dtype=np.uint8 )
+        dense_cols = []
+
+        for start in range(0, L, cls.block_size):
+            stop = min(L, start + cls.block_size)
+            block = calls[:, start:stop]
+            missing = block == missing_code
+
+            # rank of each call code within the alleles of its locus
+            present = np.zeros( (stop - start, len(call_codes)), dtype=bool )
+            for code in range(1, len(call_codes)):
+                present[:, code] = (block == code).any(0)
+            ranks = (np.cumsum(present, axis=1) - 1).clip(0).astype(np.uint8)
+            multi = present.sum(1) > 4
+            packable = ~multi
+
+            loci, codes = np.nonzero( present & packable[:, None] )
+            alleles[start + loci, ranks[loci, codes]] = codes
+            dense_cols.extend( start + np.nonzero(multi)[0] )
+
+            index = ranks[ np.arange(stop - start), block ]
+            index[:, multi] = 0
+            index[missing] = 0
+
+            width = -(-(stop - start) // 4) * 4
+            if width > stop - start:
+                index = np.pad( index, ( (0, 0), (0, width - (stop - start)) ) )
+            index = index.reshape(n, width // 4, 4)
+            packed[:, start // 4 : start // 4 + width // 4] = ( index[:, :, 0]
+                        | (index[:, :, 1] << 2) | (index[:, :, 2] << 4) | (index[:, :, 3] << 6) )
+            missing_bits[:, start // 8 : -(-stop // 8)] = np.packbits(missing, axis=1,
+                        bitorder='little')
+
+        dense_cols = np.array(dense_cols, dtype=np.intp)
+        return cls( packed, missing_bits, alleles, dense_cols, calls[:, dense_cols].copy(),
+                    matrix.sample_ids, matrix.locus_ids, matrix.depths )
+
+
+    @classmethod
+    def concatenate(cls, matrices):
+        """ return matrices stacked by rows, concatenating the packed bytes;
+            all matrices must share loci and allele coding, eg. row slices
+            of the same matrix (see same_coding)
+        """
+        if not cls.same_coding(matrices):
+            raise RuntimeError('packed genotype matrices have different loci or allele coding')
+        first = matrices[0]
+        with_depths = all( m.depths is not None for m in matrices )
+        return cls( np.concatenate( [ m.packed for m in matrices ] ),
+                    np.concatenate( [ m.missing_bits for m in matrices ] ),
+                    first.alleles, first.dense_cols,
+                    np.concatenate( [ m.dense_calls for m in matrices ] ),
+                    np.concatenate( [ m.sample_ids for m in matrices ] ), first.locus_ids,
+                    np.concatenate( [ m.depths for m in matrices ] ) if with_depths else None )
+
+
+    @staticmethod
+    def same_coding(matrices):
+        """ check whether matrices share loci and allele coding """
+        first = matrices[0]
+        return all( np.array_equal(m.locus_ids, first.locus_ids)
+                    and np.array_equal(m.alleles, first.alleles)
+                    and np.array_equal(m.dense_cols, first.dense_cols)
+                    for m in matrices[1:] )
+
+
+    @property
+    def shape(self):
+        return (self.N, self.L)
+
+
+    @property
+    def N(self):
+        return len(self.sample_ids)
+
+
+    @property
+    def L(self):
+        return len(self.locus_ids)
+
+
+    def unpack(self, start=0, stop=None):
+        """ return uint8 call codes of loci [start:stop] for all samples """
+
+        if stop is None or stop > self.L:
+            stop = self.L
+        a = (start // 8) * 8
+        b = min(self.L, -(-stop // 8) * 8)
+
+        packed = self.packed[:, a // 4 : -(-b // 4)]
+        index = np.empty( packed.shape + (4,), dtype=np.uint8 )
+        for k in range(4):
+            index[:, :, k] = (packed >> (2 * k)) & 3
+        index = index.reshape(self.N, packed.shape[1] * 4)[:, : b - a]
+
+        calls = self.alleles[ np.arange(a, b), index ]
+        missing = np.unpackbits( self.missing_bits[:, a // 8 : -(-b // 8)], axis=1,
+                    count = b - a, bitorder='little' ).view(bool)
+        calls[missing] = missing_code
+
+        in_block = (self.dense_cols >= a) & (self.dense_cols < b)
+        calls[:, self.dense_cols[in_block] - a] = self.dense_calls[:, in_block]
+
+        return calls[:, start - a : stop - a]
+
+
+    def unpack_missing(self, start=0, stop=None):
+        """ return boolean missing mask of loci [start:stop] for all samples """
+        if stop is None or stop > self.L:
+            stop = self.L
+        a = (start // 8) * 8
+        missing = np.unpackbits( self.missing_bits[:, a // 8 : -(-stop // 8)], axis=1,
+                    count = stop - a, bitorder='little' ).view(bool)
+        return missing[:, start - a :]
+
+
+    @property
+    def calls(self):
+        return self.unpack()
+
+
+    @property
+    def missing(self):
+        return self.unpack_missing()
+
+
+    def to_matrix(self):
+        return GenotypeMatrix( self.calls, self.sample_ids, self.locus_ids, self.depths )
+
+
+    def to_dataframe(self):
+        return self.to_matrix().to_dataframe()
+
+
+    def row_slice(self, start, stop):
+        """ return a PackedGenotypeMatrix view of rows [start:stop] """
+        return self.__class__( self.packed[start:stop], self.missing_bits[start:stop],
+                    self.alleles, self.dense_cols, self.dense_calls[start:stop],
+                    self.sample_ids[start:stop], self.locus_ids,
+                    None if self.depths is None else self.depths[start:stop] )
+
+
+    def take(self, sample_ids=None, locus_ids=None):
+        """ return a new PackedGenotypeMatrix with only sample_ids and locus_ids,
+            in the order of this matrix
+        """
+        if locus_ids is not None:
+            return self.__class__.from_matrix(
+                        self.to_matrix().take(sample_ids, locus_ids) )
+        if sample_ids is None:
+            return self
+        rows = np.isin(self.sample_ids, list(sample_ids))
+        return self.__class__( self.packed[rows], self.missing_bits[rows], self.alleles,
+                    self.dense_cols, self.dense_calls[rows], self.sample_ids[rows],
+                    self.locus_ids, None if self.depths is None else self.depths[rows] )
+
+
+    def genotyped_per_sample(self):
+        """ return array of number of genotyped loci for each sample """
+        return self.L - popcount(self.missing_bits).sum(1, dtype=np.int64)
+
+
+    def genotyped_per_locus(self):
+        """ return array of number of genotyped samples for each locus """
+        counts = np.empty(self.L, dtype=np.int64)
+        for start in range(0, self.L, self.block_size):
+            stop = min(self.L, start + self.block_size)
+            counts[start:stop] = self.N - self.unpack_missing(start, stop).sum(0)
+        return counts
+
+
+    def valid_bits(self):
+        """ return (samples x ceil(loci/4)) uint8 array with the low bit of each
+            2-bit call set if the call is genotyped and packed (not dense)
+        """
+        packable = np.ones(self.L, dtype=bool)
+        packable[self.dense_cols] = False
+        valid = ~self.missing_bits & np.packbits(packable, bitorder='little')
+        spread = np.empty( (self.N, valid.shape[1] * 2), dtype=np.uint8 )
+        spread[:, 0::2] = _spread_lo[valid]
+        spread[:, 1::2] = _spread_hi[valid]
+        return spread[:, : self.packed.shape[1]]
+
+
+    def hamming(self, tile=64):
+        """ return (mismatches, comparables) samples x samples matrices, counting
+            only loci genotyped in both samples, using popcount over the packed calls
+        """
+
+        n = self.N
+        mismatches = np.zeros( (n, n), dtype=np.int64 )
+        comparables = np.zeros( (n, n), dtype=np.int64 )
+        valid = self.valid_bits()
+        dense_valid = self.dense_calls != missing_code
+
+        for i in range(0, n, tile):
+            I = slice(i, min(n, i + tile))
+            for j in range(i, n, tile):
+                J = slice(j, min(n, j + tile))
+
+                both = valid[I, None, :] & valid[None, J, :]
+                diff = self.packed[I, None, :] ^ self.packed[None, J, :]
+                diff = (diff | (diff >> 1)) & both
+                mismatches[I, J] = popcount(diff).sum(-1, dtype=np.int64)
+                comparables[I, J] = popcount(both).sum(-1, dtype=np.int64)
+
+                if len(self.dense_cols):
+                    dense_both = dense_valid[I, None, :] & dense_valid[None, J, :]
+                    mismatches[I, J] += ( (self.dense_calls[I, None, :]
+                                != self.dense_calls[None, J, :]) & dense_both ).sum(-1)
+                    comparables[I, J] += dense_both.sum(-1)
+
+                mismatches[J, I] = mismatches[I, J].T
+                comparables[J, I] = comparables[I, J].T
+
+        return (mismatches, comparables)
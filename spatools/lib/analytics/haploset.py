@@ -7,14 +7,27 @@ class HaploSet(object):
     def __init__(self, analytical_set):
         self._analytical_set = analytical_set
 
-        self._haplotype_df = analytical_set.allele_df.mlgt.dropna()
-        self._sample_ids = set( self._haplotype_df.index )
+        # haplotypes are samples genotyped at all loci
+        matrix = analytical_set.genotype_matrix
+        complete = matrix.genotyped_per_sample() == matrix.L
+        self._genotype_matrix = matrix.take( matrix.sample_ids[complete] )
+        self._sample_ids = set( int(x) for x in self._genotype_matrix.sample_ids )
+        self._haplotype_df = None
+
+
+    @property
+    def genotype_matrix(self):
+        return self._genotype_matrix
 
 
     @property
     def haplotype_df(self):
+        if self._haplotype_df is None:
+            self._haplotype_df = self._genotype_matrix.to_dataframe()
         return self._haplotype_df
 
+    variant_df = haplotype_df
+
 
     @property
     def N(self):
@@ -1,49 +1,150 @@
 
 
+import warnings
 import numpy as np
-from pandas import DataFrame
+from pandas import DataFrame, Index
 from scipy.stats import wilcoxon, kruskal
 
+from spatools.lib.analytics.genotype import call_codes, missing_code
 
-def summarize_he( analytical_sets ):
+
+def summarize_he( analytical_sets, replicates=1000, alpha=0.05, seed=None ):
+    """ He of all analytical sets, with bootstrap confidence intervals of the
+        mean He of each set from resampling its samples
+    """
 
     results = {}
-    he = {}
+    analytical_sets = list(analytical_sets)
+    labels = [ analytical_set.label for analytical_set in analytical_sets ]
+    matrices = [ analytical_set.genotype_matrix for analytical_set in analytical_sets ]
 
-    for analytical_set in analytical_sets:
-        he[analytical_set.label] = calculate_he(analytical_set.allele_df)
+    counts, locus_ids = allele_counts( matrices )
+    he_df = DataFrame( expected_heterozygosity(counts).T, index=locus_ids, columns=labels )
 
-    he_df = DataFrame( he )
-    labels = list(he_df.columns)
     if len(labels) == 2:
         # use Mann-Whitney / Wilcoxon test
         results['test'] = 'Wilcoxon test (paired)'
-        results['stats'] = wilcoxon( he_df[labels[0]], he_df[labels[1]])
+        tested_df = he_df.dropna()
+        results['stats'] = wilcoxon( tested_df[labels[0]], tested_df[labels[1]])
 
     elif len(labels) > 2:
         # use Kruskal Wallis
         results['test'] = 'Kruskal-Wallis test'
-        results['stats'] = kruskal( * [he_df[x] for x in labels])
+        tested_df = he_df.dropna()
+        results['stats'] = kruskal( * [tested_df[x] for x in labels])
         results['warning'] = ''
 
     results['data'] = he_df
     results['mean'] = he_df.mean()
     results['stddev'] = he_df.std()
-    #raise RuntimeError
+
+    if replicates > 0:
+        rng = np.random.default_rng(seed)
+        mean_ci = []
+        locus_ci = {}
+        for label, matrix in zip(labels, matrices):
+            set_mean_ci, set_locus_ci = bootstrap_he( matrix.take(locus_ids=locus_ids),
+                        replicates=replicates, alpha=alpha, rng=rng )
+            mean_ci.append( set_mean_ci )
+            locus_ci[label] = DataFrame( set_locus_ci, index=locus_ids,
+                        columns=['lower', 'upper'] )
+        results['ci'] = DataFrame( mean_ci, index=labels, columns=['lower', 'upper'] )
+        results['locus_ci'] = locus_ci
+        results['replicates'] = replicates
 
     return results
 
 
 def calculate_he(allele_df, adjust=True):
-    """ He is calculated using major allele """
-    marker_he = {}
-
-    dist = allele_df.dominant_df_distribution
-    for marker_id in dist.index.levels[0]:
-        total = dist[marker_id].sum()
-        he = 1.0 - sum( (x/total)**2 for x in dist[marker_id] )
-        if adjust and total > 1:
-            he = he *total / (total-1)
-        marker_he[marker_id] = he
-
-    return marker_he
+    """ return dict of { marker_id: He } from the calls of the genotype matrix,
+        with n/(n-1) small sample adjustment if adjust is True
+    """
+
+    counts, locus_ids = allele_counts( [ allele_df.genotype_matrix ] )
+    he = expected_heterozygosity(counts, adjust)[0]
+    return dict( zip(locus_ids.tolist(), he.tolist()) )
+
+
+def allele_counts(matrices, locus_ids=None):
+    """ return ( sets x loci x alleles array of allele counts, locus ids ),
+        where alleles are indexed by call code and missing calls are not
+        counted; loci default to those of the first matrix
+    """
+
+    if locus_ids is None:
+        locus_ids = matrices[0].locus_ids
+    locus_ids = Index(locus_ids)
+    S, L, K = len(matrices), len(locus_ids), len(call_codes)
+
+    # one bincount over (set, locus, allele) keys of all stacked calls
+    keys = []
+    for s, matrix in enumerate(matrices):
+        cols = Index(matrix.locus_ids).get_indexer(locus_ids)
+        if (cols < 0).any():
+            raise RuntimeError('analytical sets do not share the same loci')
+        calls = np.asarray(matrix.calls)[:, cols]
+        keys.append( ((s * L + np.arange(L)) * K + calls).ravel() )
+    keys = np.concatenate(keys) if keys else np.zeros(0, dtype=np.int64)
+
+    counts = np.bincount(keys, minlength=S * L * K).reshape(S, L, K)
+    counts[:, :, missing_code] = 0
+    return counts, locus_ids
+
+
+def expected_heterozygosity(counts, adjust=True):
+    """ return He = 1 - sum(p^2) over the last axis of allele counts, with
+        n/(n-1) small sample adjustment; He is NaN where nothing was counted
+    """
+
+    counts = np.asarray(counts, dtype=np.float64)
+    n = counts.sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        he = 1.0 - (counts**2).sum(axis=-1) / (n * n)
+        if adjust:
+            he = np.where(n > 1, he * n / (n - 1), he)
+    return he
+
+
+def bootstrap_he(matrix, replicates=1000, alpha=0.05, adjust=True, rng=None, batch=200):
+    """ return ( (lower, upper) of mean He, loci x 2 array of (lower, upper)
+        of He ) as bias-corrected percentile intervals from resampling samples
+        with replacement; each batch of replicates is drawn as multinomial
+        sample weights, and the allele counts of all replicates in the batch
+        are obtained as one weights x indicator product per allele
+
+        resamples contain duplicated samples, hence their He is biased down
+        by about (n-1)/n; the percentiles are shifted by the difference
+        between the He of the samples and the mean of the replicates
+    """
+
+    if rng is None:
+        rng = np.random.default_rng()
+    calls = np.asarray(matrix.calls)
+    N, L = calls.shape
+    alleles = [ code for code in range(len(call_codes)) if code != missing_code ]
+
+    he = np.empty( (replicates, L), dtype=np.float32 )
+    if N == 0:
+        he.fill(np.nan)
+
+    indicators = [ (calls == code).astype(np.float32) for code in alleles ]
+    for start in range(0, replicates if N else 0, batch):
+        stop = min(start + batch, replicates)
+        weights = rng.multinomial(N, np.full(N, 1.0 / N), size=stop - start).astype(np.float32)
+        counts = np.stack( [ weights @ indicator for indicator in indicators ], axis=-1 )
+        he[start:stop] = expected_heterozygosity(counts, adjust)
+
+    counts, _ = allele_counts( [ matrix ] )
+    estimate = expected_heterozygosity(counts, adjust)[0]
+
+    q = [ 100 * alpha / 2, 100 * (1 - alpha / 2) ]
+    with warnings.catch_warnings():
+        # loci without any genotyped sample give all-NaN slices
+        warnings.simplefilter('ignore', RuntimeWarning)
+        means = np.nanmean(he, axis=1)
+        mean_ci = ( np.nanpercentile(means, q)
+                    + np.nanmean(estimate) - np.nanmean(means) )
+        locus_ci = ( np.nanpercentile(he, q, axis=0)
+                    + estimate - np.nanmean(he, axis=0) ).T
+
+    return mean_ci, locus_ci
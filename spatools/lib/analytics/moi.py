@@ -1,4 +1,5 @@
 
+import numpy as np
 import pandas
 from scipy.stats import ranksums, kruskal
 
@@ -60,7 +61,7 @@ def calculate_moi(allele_df):
     am = allele_df.allele_multiplicity
     sm = allele_df.sample_multiplicity
 
-    am_filter = am.applymap(lambda x: 1 if x > 1 else 0)
+    am_filter = (am > 1).astype(int)
     am_filter_dist = am_filter.sum(1)
 
     moi.sample_dist = pandas.concat([sm, am_filter_dist], axis=1)
@@ -77,13 +78,11 @@ def calculate_moi(allele_df):
     moi.markers = am_filter.sum()
     moi.markers.sort_values(ascending=False, inplace=True)
 
-    # polyclonality ranks
-    moi.markers_rank = []
-    marker_id_rank = []
-    for (marker_id, polyclonality) in moi.markers.items():
-        marker_id_rank.append( marker_id )
-        temp_df = am_filter[marker_id_rank].apply(lambda x: 1 if any(x) else 0, axis=1)
-        moi.markers_rank.append( (marker_id, sum(temp_df)) )
+    # polyclonality ranks: number of samples being polyclonal in any of the
+    # markers up to each marker, with markers ordered by polyclonality
+    polyclonal = am_filter[moi.markers.index].values.astype(bool)
+    ranks = np.logical_or.accumulate(polyclonal, axis=1).sum(axis=0)
+    moi.markers_rank = list( zip(moi.markers.index, ranks.tolist()) )
 
     return moi
 
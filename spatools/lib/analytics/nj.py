@@ -1,10 +1,40 @@
 # Neighbor-joining tree from distance matrix
 
+import numpy as np
 from subprocess import call
 from spatools.lib.utils import random_string
 
 
-def plot_nj( distance_matrix, tmp_dir, fmt='pdf', label_callback=None, tree_type='fan', branch_coloring=True ):
+def plot_nj( distance_matrix, tmp_dir, fmt='pdf', label_callback=None, tree_type='fan',
+            branch_coloring=True, tree=None ):
+    """ compute NJ tree in-process and plot it with matplotlib, return the
+        filename of the plot; tree_type is 'fan', 'unrooted' or 'rectangular'
+    """
+
+    from spatools.lib.analytics import treeplot
+
+    tree = tree or get_nj_tree( distance_matrix )
+    njtree_file = '%s/njtree-%s.%s' % (tmp_dir, random_string(3), fmt)
+    if fmt == 'pdf':
+        figsize, dpi = (11.2, 7), 100
+    elif fmt == 'png':
+        figsize, dpi = (10.24, 6.4), 100
+    else:
+        raise RuntimeError('unknown plot format: %s' % fmt)
+
+    tip_labels = None
+    if label_callback:
+        tip_labels = [ label_callback(sample_id) for sample_id in tree.labels ]
+
+    return treeplot.plot_tree( tree, njtree_file, tree_type,
+                tip_colours = list(distance_matrix.C),
+                tip_labels = tip_labels,
+                legend = [ (hs.label, hs.colour) for (hs,_,_) in distance_matrix.S ],
+                branch_coloring = branch_coloring,
+                figsize = figsize, dpi = dpi )
+
+
+def plot_nj_r( distance_matrix, tmp_dir, fmt='pdf', label_callback=None, tree_type='fan', branch_coloring=True ):
     """ NJ uses R's ape library
         R will be called as a separate process instead as a embedded library
         in order to utilize paralel processing in multiple processor
@@ -24,10 +54,7 @@ def plot_nj( distance_matrix, tmp_dir, fmt='pdf', label_callback=None, tree_type
 
     with open(matrix_file, 'w') as out_m, open(colors_file, 'w') as out_c:
 
-        out_m.write( '\t'.join( str(x) for x in distance_matrix.sample_ids ) )
-        out_m.write( '\n')
-        for name, vals in zip( distance_matrix.sample_ids, distance_matrix.M ):
-            out_m.write( '%s\t%s\n' % (str(name), '\t'.join( ['%2.3f' % x for x in vals] ) ))
+        distance_matrix.write_matrix( out_m )
 
         out_c.write('\n'.join( distance_matrix.C ) )
         out_c.write('\n')
@@ -94,3 +121,486 @@ legend('topright', inset=c(0,0), c(%s), col = c(%s), lty=1, cex=0.85, xpd=T)
         raise RuntimeError("Rscript %s run unsucessfully" % script_file)
 
     return njtree_file
+
+
+#
+# In-process neighbor-joining
+# ===========================
+#
+# neighbor_joining() follows Saitou & Nei (1987) as implemented in ape::nj,
+# working in-place on a compacted copy of the distance matrix: the joined
+# node replaces row i and the last active row is moved into row j.
+#
+# The fast variant follows RapidNJ (Simonsen et al. 2008): each node keeps
+# its distances to the other nodes sorted, and since
+# Q(i, j) >= (m-2) d(i, j) - r_i - max(r_j), the sorted list of row i is only
+# scanned up to the first distance whose bound reaches the best Q found so
+# far.  As in NINJA (Wheeler 2009), the nodes are put into bins of r and each
+# list is sorted within the bins, so max(r_j) is taken per bin rather than
+# over all nodes.  The lists are kept across joins, entries of joined nodes
+# are skipped, and only the list of the new node is sorted after each join;
+# all lists are rebuilt whenever a quarter of the nodes has been joined.
+# The lists of all rows are scanned together, a block of entries at a time.
+#
+
+
+class Tree(object):
+    """ unrooted tree, nodes 0..n_tips-1 are the tips and the last node is the
+        root, ie. the final trifurcation (or the middle of the only branch of
+        a tree of two tips)
+        parent: array of parent node of each node (-1 for the root)
+        length: array of branch length to the parent of each node
+        labels: list of label of each tip
+    """
+
+    def __init__(self, parent, length, labels):
+        self.parent = np.asarray(parent)
+        self.length = np.asarray(length, dtype=np.float64)
+        self.labels = list(labels)
+        self._children = None
+
+
+    @property
+    def n_tips(self):
+        return len(self.labels)
+
+
+    @property
+    def n_nodes(self):
+        return len(self.parent)
+
+
+    @property
+    def root(self):
+        return self.n_nodes - 1
+
+
+    @property
+    def children(self):
+        """ list of children of each node, in the order of joining """
+        if self._children is None:
+            children = [ [] for _ in range(self.n_nodes) ]
+            for node, parent in enumerate(self.parent):
+                if parent >= 0:
+                    children[parent].append(node)
+            self._children = children
+        return self._children
+
+
+    def postorder(self):
+        """ return array of nodes with children before their parent """
+        order = []
+        stack = [ self.root ]
+        children = self.children
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            stack.extend(children[node])
+        return np.array(order[::-1], dtype=np.int64)
+
+
+    def splits(self):
+        """ return set of non-trivial bipartitions, each as frozenset of the two
+            frozensets of tip labels
+        """
+        n = self.n_tips
+        below = [ None ] * self.n_nodes
+        splits = set()
+        all_tips = frozenset(range(n))
+        for node in self.postorder():
+            if node < n:
+                below[node] = frozenset([node])
+                continue
+            below[node] = frozenset().union( *(below[c] for c in self.children[node]) )
+            if node == self.root or not (1 < len(below[node]) < n - 1):
+                continue
+            splits.add( frozenset( [ frozenset( self.labels[t] for t in below[node] ),
+                        frozenset( self.labels[t] for t in all_tips - below[node] ) ] ) )
+        return splits
+
+
+    def to_newick(self, label_func=None, fmt='%.6g', comments=None):
+        """ return Newick string; label_func converts tip label to string,
+            comments is an optional list of comment of each node, written
+            as [comment] before the branch length
+        """
+        label_func = label_func or str
+        n = self.n_tips
+        children = self.children
+        out = []
+        stack = [ self.root ]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                out.append(item)
+                continue
+            suffix = '' if item == self.root else ':' + fmt % self.length[item]
+            if comments is not None and comments[item]:
+                suffix = '[%s]%s' % (comments[item], suffix)
+            if item < n:
+                out.append( newick_label( label_func(self.labels[item]) ) + suffix )
+                continue
+            stack.append( ')' + suffix )
+            nodes = children[item]
+            for k, child in enumerate(reversed(nodes)):
+                stack.append(child)
+                if k < len(nodes) - 1:
+                    stack.append(',')
+            stack.append('(')
+        out.append(';')
+        return ''.join(out)
+
+
+def newick_label( label ):
+    """ return label quoted for Newick if it contains special characters """
+    label = str(label)
+    if any( c in label for c in " ()[]':;," ):
+        return "'%s'" % label.replace("'", "''")
+    return label
+
+
+def parse_newick( text ):
+    """ return Tree from Newick string, with the top-level node as the root """
+
+    parent, length, labels, tips = [], [], [], []
+    stack = []
+    current = None
+    pos, size = 0, len(text)
+
+    def new_node(p):
+        parent.append(p)
+        length.append(0.0)
+        labels.append(None)
+        return len(parent) - 1
+
+    while pos < size:
+        c = text[pos]
+        if c == '(':
+            current = new_node( stack[-1] if stack else -1 )
+            stack.append(current)
+            pos += 1
+        elif c == ',' or c == ')':
+            if c == ')':
+                current = stack.pop()
+            pos += 1
+        elif c == ':':
+            end = pos + 1
+            while end < size and text[end] not in ',);':
+                end += 1
+            length[current] = float(text[pos+1:end])
+            pos = end
+        elif c == ';':
+            break
+        elif c.isspace():
+            pos += 1
+        elif c == '[':
+            # skip comments
+            pos = text.index(']', pos) + 1
+        else:
+            if c == "'":
+                end = pos + 1
+                while end < size and not (text[end] == "'" and text[end+1:end+2] != "'"):
+                    end += 2 if text[end] == "'" else 1
+                label = text[pos+1:end].replace("''", "'")
+                end += 1
+            else:
+                end = pos
+                while end < size and text[end] not in ':,);[':
+                    end += 1
+                label = text[pos:end].strip()
+            if text[pos-1] == ')':
+                # internal node label
+                labels[current] = label
+            else:
+                current = new_node( stack[-1] if stack else -1 )
+                labels[current] = label
+                tips.append(current)
+            pos = end
+
+    # renumber as tips first, then internal nodes with the root last
+    tip_set = set(tips)
+    internals = [ i for i in range(len(parent)) if i not in tip_set and i != 0 ]
+    # a single tip is the root itself
+    order = tips + internals + ( [] if 0 in tip_set else [0] )
+    index = np.empty(len(order), dtype=np.int64)
+    index[order] = np.arange(len(order))
+    new_parent = [ index[parent[i]] if parent[i] >= 0 else -1 for i in order ]
+    return Tree( new_parent, [ length[i] for i in order ], [ labels[i] for i in tips ] )
+
+
+def neighbor_joining( D, labels=None, fast=False, block=8, overwrite=False ):
+    """ return Tree of neighbor-joining of square distance matrix D;
+        block is the number of sorted entries per row scanned at a time
+        by the fast variant; overwrite = True works on float64 D in place
+        instead of on a copy
+    """
+
+    D = np.asarray(D, dtype=np.float64) if overwrite else np.array(D, dtype=np.float64)
+    n = len(D)
+    labels = list(range(n)) if labels is None else list(labels)
+
+    if n < 3:
+        if n == 2:
+            # both tips joined to a root node at the middle of the branch
+            half = 0.5 * D[0, 1]
+            return Tree( [2, 2, -1], [half, half, 0], labels )
+        return Tree( np.full(n, -1), np.zeros(n), labels )
+
+    if fast:
+        return _fast_neighbor_joining(D, labels, block)
+
+    n_nodes = 2 * n - 2
+    parent = np.full(n_nodes, -1, dtype=np.int64)
+    length = np.zeros(n_nodes, dtype=np.float64)
+
+    nodes = np.arange(n)
+    r = D.sum(1)
+    m = n
+    u = n
+
+    while m > 3:
+
+        Q = (m - 2) * D[:m, :m] - r[:m, None] - r[None, :m]
+        np.fill_diagonal(Q, np.inf)
+        i, j = divmod( int(Q.argmin()), m )
+        i, j = min(i, j), max(i, j)
+
+        dij = D[i, j]
+        li = 0.5 * dij + (r[i] - r[j]) / (2 * (m - 2))
+        parent[nodes[i]] = parent[nodes[j]] = u
+        length[nodes[i]] = li
+        length[nodes[j]] = dij - li
+
+        du = 0.5 * (D[i, :m] + D[j, :m] - dij)
+        du[i] = du[j] = 0
+        r[:m] += du - D[i, :m] - D[j, :m]
+        r[i] = du.sum()
+        D[i, :m] = du
+        D[:m, i] = du
+        nodes[i] = u
+
+        # move the last active row into row j
+        last = m - 1
+        if j != last:
+            D[j, :m] = D[last, :m]
+            D[:m, j] = D[:m, last]
+            D[j, j] = 0
+            nodes[j] = nodes[last]
+            r[j] = r[last]
+        m -= 1
+        u += 1
+
+    _join_root(D, np.arange(3), nodes, parent, length, u)
+    return Tree(parent, length, labels)
+
+
+def _join_root( D, slots, nodes, parent, length, u ):
+    """ join the last three nodes at slots to the root u """
+    a, b, c = slots
+    for x, y, z in ( (a, b, c), (b, a, c), (c, a, b) ):
+        parent[nodes[x]] = u
+        length[nodes[x]] = 0.5 * (D[x, y] + D[x, z] - D[y, z])
+
+
+def _sort_rows( D, rows, active_rows, bins, n_bins, nodes, S, SD, seg, sentinel, chunk=256 ):
+    """ fill the lists S (nodes) and SD (distances) of rows with the other
+        active rows, grouped by bin and sorted by distance within each bin;
+        seg holds the start of each bin in the lists; distances are float32
+        rounded down so that they stay lower bounds
+    """
+    k = len(active_rows) - 1
+    col_bins = bins[active_rows]
+    counts = np.bincount(col_bins, minlength=n_bins)
+    for start in range(0, len(rows), chunk):
+        R = rows[start:start + chunk]
+        d = D[R[:, None], active_rows]
+        key = np.repeat( col_bins[None, :], len(R), axis=0 )
+        self_cols = R[:, None] == active_rows
+        d[self_cols] = np.inf
+        key[self_cols] = n_bins
+        # sort by distance, then stable sort by bin
+        order = np.argsort(d, axis=1)
+        order = np.take_along_axis( order,
+                    np.argsort( np.take_along_axis(key, order, axis=1), axis=1, kind='stable' ),
+                    axis=1 )[:, :k]
+        d = np.take_along_axis(d, order, axis=1)
+        lower = d.astype(np.float32)
+        over = lower > d
+        lower[over] = np.nextafter( lower[over], np.float32(-np.inf) )
+        S[R] = sentinel
+        SD[R] = np.inf
+        S[R, :k] = nodes[ active_rows[order] ]
+        SD[R, :k] = lower
+        seg[R, 0] = 0
+        seg[R, 1:] = np.cumsum(counts) - ( np.arange(n_bins) >= bins[R, None] )
+
+
+def _fast_neighbor_joining( D, labels, block, n_bins=8 ):
+    """ RapidNJ-style neighbor-joining, D is modified in place; rows of D are
+        slots, the joined node takes the slot of i and the slot of j is freed
+    """
+
+    n = len(D)
+    n_nodes = 2 * n - 2
+    parent = np.full(n_nodes, -1, dtype=np.int64)
+    length = np.zeros(n_nodes, dtype=np.float64)
+
+    # node n_nodes is the sentinel padding the lists, never alive
+    alive = np.zeros(n_nodes + 1, dtype=bool)
+    alive[:n] = True
+    slot_of = np.zeros(n_nodes + 1, dtype=np.int64)
+    slot_of[:n] = np.arange(n)
+    nodes = np.arange(n)
+
+    active = np.ones(n, dtype=bool)
+    r = D.sum(1)
+    m = n
+    u = n
+
+    # lists of (node, distance) of each slot, without the slot itself; the
+    # lists and the bins of r are rebuilt once m drops below rebuild_at
+    S = np.empty( (n, n), dtype=np.int32 )
+    SD = np.empty( (n, n), dtype=np.float32 )
+    seg = np.zeros( (n, n_bins + 1), dtype=np.int64 )
+    bins = np.zeros(n, dtype=np.int64)
+    rebuild_at = n
+    steps = np.arange(block)
+    all_bins = np.arange(n_bins)
+
+    while m > 3:
+
+        rows = np.flatnonzero(active)
+        if m <= rebuild_at:
+            edges = np.quantile( r[rows], np.linspace(0, 1, n_bins + 1)[1:-1] )
+            bins[rows] = np.searchsorted(edges, r[rows])
+            _sort_rows(D, rows, rows, bins, n_bins, nodes, S, SD, seg, n_nodes)
+            rebuild_at = m * 3 // 4
+
+        max_r = np.full(n_bins, -np.inf)
+        np.maximum.at(max_r, bins[rows], r[rows])
+
+        # the sorted bins of all rows are scanned a block of entries at a time,
+        # starting with the best Q among the first entries of the bins with
+        # the lowest bounds
+        prow = np.repeat(rows, n_bins)
+        pbin = np.tile(all_bins, len(rows))
+        pos = seg[prow, pbin]
+        end = seg[prow, pbin + 1]
+        more = pos < end
+        prow, pbin, pos, end = prow[more], pbin[more], pos[more], end[more]
+        bound = (m - 2) * SD[prow, pos].astype(np.float64) - r[prow] - max_r[pbin]
+        seed = np.argsort(bound)[:m]
+        j = slot_of[ S[prow[seed], pos[seed]] ]
+        Q = (m - 2) * D[prow[seed], j] - r[prow[seed]] - r[j]
+        Q[ ~alive[ S[prow[seed], pos[seed]] ] ] = np.inf
+        k = int(Q.argmin())
+        best, best_ij = Q[k], ( int(prow[seed][k]), int(j[k]) )
+
+        while True:
+            more = pos < end
+            prow, pbin, pos, end = prow[more], pbin[more], pos[more], end[more]
+            bound = (m - 2) * SD[prow, pos].astype(np.float64) - r[prow] - max_r[pbin]
+            more = bound < best
+            prow, pbin, pos, end = prow[more], pbin[more], pos[more], end[more]
+            if not len(prow):
+                break
+
+            cols = pos[:, None] + steps
+            other = S[prow[:, None], np.minimum(cols, n - 1)]
+            j = slot_of[other]
+            Q = (m - 2) * D[prow[:, None], j] - r[prow, None] - r[j]
+            Q[ ~alive[other] | (cols >= end[:, None]) ] = np.inf
+            k = int(Q.argmin())
+            if Q.flat[k] < best:
+                best = Q.flat[k]
+                best_ij = ( int(prow[k // block]), int(j.flat[k]) )
+            pos = pos + block
+
+        i, j = best_ij
+        dij = D[i, j]
+        li = 0.5 * dij + (r[i] - r[j]) / (2 * (m - 2))
+        parent[nodes[i]] = parent[nodes[j]] = u
+        length[nodes[i]] = li
+        length[nodes[j]] = dij - li
+
+        alive[ nodes[i] ] = alive[ nodes[j] ] = False
+        active[j] = False
+        rows = np.flatnonzero(active)
+
+        du = 0.5 * (D[i, rows] + D[j, rows] - dij)
+        du[ rows == i ] = 0
+        r[rows] += du - D[i, rows] - D[j, rows]
+        r[i] = du.sum()
+        D[i, rows] = du
+        D[rows, i] = du
+
+        nodes[i] = u
+        alive[u] = True
+        slot_of[u] = i
+
+        # list of the new node
+        bins[i] = np.searchsorted(edges, r[i])
+        _sort_rows(D, np.array([i]), rows, bins, n_bins, nodes, S, SD, seg, n_nodes)
+
+        m -= 1
+        u += 1
+
+    _join_root(D, np.flatnonzero(active), nodes, parent, length, u)
+    return Tree(parent, length, labels)
+
+
+# use the fast variant for matrices with at least this number of samples
+fast_nj_threshold = 1000
+
+def get_nj_tree( distance_matrix, fast=None ):
+    """ return neighbor-joining Tree of DistanceMatrix, with sample_ids as labels """
+    n = distance_matrix.total_samples
+    if fast is None:
+        fast = n >= fast_nj_threshold
+    # NJ updates the matrix at each join, hence it works on a square copy
+    # of the distances regardless of the storage
+    return neighbor_joining( distance_matrix.square(), distance_matrix.sample_ids.tolist(),
+                fast = fast, overwrite = True )
+
+
+def r_nj_newick( distance_matrix, tmp_dir ):
+    """ return Newick string of ape::nj, for cross-checking get_nj_tree() """
+
+    file_id = random_string(3)
+    matrix_file = '%s/matrix-distance-%s.txt' % (tmp_dir, file_id)
+    script_file = '%s/njnewick-%s.r' % (tmp_dir, file_id)
+    newick_file = '%s/njnewick-%s.txt' % (tmp_dir, file_id)
+
+    with open(matrix_file, 'w') as out_m:
+        distance_matrix.write_matrix( out_m, fmt='%.9g' )
+    with open(script_file, 'w') as scriptout:
+        scriptout.write("""
+library(ape)
+M <- as.matrix( read.table("%s", sep='\\t', header=T, check.names=F) )
+write.tree( nj( M ), file = "%s", digits = 9 )
+""" % (matrix_file, newick_file) )
+
+    ok = call( ['Rscript', script_file] )
+    if ok != 0:
+        raise RuntimeError("Rscript %s run unsucessfully" % script_file)
+
+    with open(newick_file) as f:
+        return f.read().strip()
+
+
+def cross_check_r( distance_matrix, tmp_dir, tree=None ):
+    """ return Robinson-Foulds distance between tree (or get_nj_tree()) and
+        the tree of ape::nj
+    """
+    tree = tree or get_nj_tree( distance_matrix )
+    if tree.n_tips < 3:
+        # ape::nj needs at least 3 samples, and trees of less than 3 tips
+        # have no splits; check that every sample is a tip of the tree instead
+        tips = parse_newick( tree.to_newick() ).labels
+        return len( set(tips).symmetric_difference(
+                    str(x) for x in distance_matrix.sample_ids.tolist() ) )
+    r_tree = parse_newick( r_nj_newick( distance_matrix, tmp_dir ) )
+    # labels read from Newick are strings
+    ours = set( frozenset( frozenset( str(x) for x in side ) for side in split )
+                    for split in tree.splits() )
+    return len( ours.symmetric_difference( r_tree.splits() ) )
@@ -4,6 +4,9 @@ from spatools.lib.utils import cerr, cout
 from spatools.lib.analytics.selector import Selector, Filter
 from spatools.lib.analytics.analyticalset import get_analytical_sets
 from spatools.lib.analytics.haploset import get_haplotype_sets
+from spatools.lib.analytics.dataframes import AlleleDataFrame
+from spatools.lib.analytics.resultcache import fingerprint, get_result_cache
+from spatools.lib.analytics.dist import get_distance_matrix, get_distance_function
 from pandas import DataFrame
 from pprint import pprint
 
@@ -24,9 +27,17 @@ def load_yaml(yaml_text):
 
 class Query(object):
 
-    def __init__(self, query_params, dbh):
+    def __init__(self, query_params, dbh, result_cache=None):
+        """ result_cache is an optional QueryResultCache instance, otherwise the
+            cache set as 'result_cache_dir' in the options is used if any
+        """
         self._params = query_params
         self._dbh = dbh
+        if result_cache is None:
+            result_cache = get_result_cache( query_params.get('options') )
+        self._result_cache = result_cache
+        self._result_key = None
+        self._result_entry = None
         self._sample_sets = None
         self._analytical_sets = None
         self._filtered_sample_sets = None
@@ -56,16 +67,61 @@ class Query(object):
         if self._analytical_sets is None or sample_ids:
             cerr('[query]: getting initial analytical sets')
             sample_sets = self.get_sample_sets( sample_ids )
+            params = self._params['filter']
+
+            allele_df = None
+            self._result_entry = self.get_cached_result( sample_sets )
+            if self._result_entry is not None:
+                cerr('[query]: using cached query result')
+                allele_df = AlleleDataFrame( None, sample_sets.sample_ids,
+                                self._result_entry['marker_ids'], params,
+                                df = self._result_entry['allele_df'],
+                                genotype_matrix = self._result_entry['genotype_matrix'] )
+
             self._analytical_sets = get_analytical_sets( self._dbh, sample_sets,
-                                        self._params['filter'] )
+                                        params, allele_df = allele_df )
             cerr('[query]: initial total samples: %d' % self._analytical_sets.total_samples)
         return self._analytical_sets
 
 
+    def get_cached_result(self, sample_sets):
+        """ return cached result entry of sample_sets, or None """
+        self._result_key = None
+        if self._result_cache is None:
+            return None
+        data_versions = self._dbh.get_data_versions( sample_sets.sample_ids )
+        params = self._params['filter']
+        self._result_key = fingerprint( sample_sets, params.get_marker_ids(self._dbh),
+                                        params, data_versions )
+        return self._result_cache.get( self._result_key )
+
+
+    def store_result(self, filtered_sample_ids, filtered_marker_ids):
+        """ store initial allele dataframe and filtered ids to result cache """
+        if self._result_key is None:
+            return
+        shared_allele_df = self.get_analytical_sets().shared_allele_df
+        self._result_entry = {
+                'allele_df': shared_allele_df.df,
+                'genotype_matrix': shared_allele_df.genotype_matrix,
+                'marker_ids': shared_allele_df.marker_ids,
+                'filtered_sample_ids': filtered_sample_ids,
+                'filtered_marker_ids': filtered_marker_ids,
+        }
+        self._result_cache.put( self._result_key, self._result_entry )
+
+
+    def get_filtered_sample_ids(self):
+        analytical_sets = self.get_analytical_sets()
+        if self._result_entry is not None:
+            return self._result_entry['filtered_sample_ids']
+        return analytical_sets.get_filtered_sample_ids()
+
+
     def get_filtered_sample_sets(self, sample_ids = None):
         if self._filtered_sample_sets is None or sample_ids:
             if not sample_ids:
-                sample_ids = self.get_analytical_sets().get_filtered_sample_ids()
+                sample_ids = self.get_filtered_sample_ids()
             self._filtered_sample_sets = self.get_sample_sets().filtered( sample_ids )
             cerr('[query]: filtered total samples: %d' %
                     self._filtered_sample_sets.total_samples)
@@ -78,20 +134,25 @@ class Query(object):
             # get initial sample set, and filter the sample set by sample ids
             filtered_sample_sets = self.get_filtered_sample_sets(sample_ids)
 
-            # create new analytical sets based on the filtered sample sets
-            cerr('[query]: getting analytical sets with filtered sample sets')
-            filtered_analytical_sets = get_analytical_sets( self._dbh, filtered_sample_sets,
-                                        self._params['filter'] )
+            # create new analytical sets based on the filtered sample sets,
+            # by filtering the already loaded initial analytical sets
+            cerr('[query]: filtering analytical sets with filtered sample sets')
+            filtered_analytical_sets = self.get_analytical_sets().get_filtered_analytical_sets(
+                                        sample_ids = filtered_sample_sets.sample_ids )
             cerr('[query]: filtered total samples: %d'
                         % filtered_analytical_sets.total_samples)
 
             # get filtered marker ids
-            filtered_marker_ids = filtered_analytical_sets.get_filtered_marker_ids()
+            if not sample_ids and self._result_entry is not None:
+                filtered_marker_ids = self._result_entry['filtered_marker_ids']
+            else:
+                filtered_marker_ids = filtered_analytical_sets.get_filtered_marker_ids()
+                if not sample_ids:
+                    self.store_result( filtered_sample_sets.sample_ids, filtered_marker_ids )
             cerr('[query]: filtered marker ids: %s' % str(filtered_marker_ids))
 
             # filter markers by retaining marker ids and removing others
-            filtered_analytical_sets = get_analytical_sets( self._dbh, filtered_sample_sets,
-                                        self._params['filter'],
+            filtered_analytical_sets = filtered_analytical_sets.get_filtered_analytical_sets(
                                         marker_ids = filtered_marker_ids )
 
             self._filtered_analytical_sets = filtered_analytical_sets
@@ -106,6 +167,15 @@ class Query(object):
         return self._filtered_haplotype_sets
 
 
+    def get_distance_matrix(self, **kwargs):
+        """ return DistanceMatrix of filtered haplotype sets, using the metric
+            set as 'distance_metric' in the options
+        """
+        return get_distance_matrix( self.get_filtered_haplotype_sets(),
+                    dfunc = get_distance_function( self._params.get('options') ),
+                    **kwargs )
+
+
     def get_sample_summary(self, mode='allele'):
         """ return a pandas dataframe containing (label, initial, filtered) headings
             since sample_summary does not involve analysis anymore, it is included here
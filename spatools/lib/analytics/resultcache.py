@@ -0,0 +1,124 @@
+#
+# resultcache.py
+#
+# Persistent query-result cache
+# =============================
+#
+# results of a query (allele dataframe, genotype matrix, filtered sample and
+# marker ids) are stored as pickle files under a content-addressed key, ie.
+# a hash of the resolved sample ids, marker ids, filter parameters and data
+# versions of the batches containing the samples.  Uploading genotypes bumps
+# the data version of the batch, hence stale results are never looked up.
+# Least recently used entries are evicted when the cache exceeds its size.
+#
+# The cache is enabled per query by setting 'result_cache_dir' (and optionally
+# 'result_cache_size' in bytes) in the query options, or by passing a
+# QueryResultCache instance to Query().
+#
+# Entries are loaded with pickle, which can execute arbitrary code: the cache
+# directory must be trusted, ie. writable only by the users running queries.
+#
+
+import os, hashlib, pickle
+
+from spatools.lib.utils import cverr, random_string
+
+
+# Filter attributes that determine the result of a query
+filter_fields = ( 'markers', 'marker_ids', 'panel_ids', 'abs_threshold', 'rel_threshold',
+                  'rel_cutoff', 'sample_qual_threshold', 'marker_qual_threshold', 'sample_filtering',
+                  'genotype_storage', 'genotype_depths' )
+
+
+def fingerprint(sample_sets, marker_ids, params, data_versions):
+    """ return hex digest of sample sets, marker ids, filter parameters and
+        data versions { batch_id: version }
+    """
+    h = hashlib.sha1()
+    for sample_set in sample_sets:
+        h.update( repr( (sample_set.label, sorted(sample_set.sample_ids)) ).encode('UTF-8') )
+    h.update( repr( sorted(marker_ids) if marker_ids else None ).encode('UTF-8') )
+    h.update( repr( [ (f, getattr(params, f, None)) for f in filter_fields ] ).encode('UTF-8') )
+    h.update( repr( sorted(data_versions.items()) ).encode('UTF-8') )
+    return h.hexdigest()
+
+
+def get_result_cache( options ):
+    """ return QueryResultCache set as 'result_cache_dir' in query options,
+        or None if not set
+    """
+    options = options or {}
+    cache_dir = options.get('result_cache_dir')
+    if not cache_dir:
+        return None
+    max_size = options.get('result_cache_size')
+    if max_size:
+        return QueryResultCache( cache_dir, int(max_size) )
+    return QueryResultCache( cache_dir )
+
+
+class QueryResultCache(object):
+
+    def __init__(self, cache_dir, max_size = 2 * 1024**3):
+        """ max_size is the size cap of the cache in bytes; entries are pickle
+            files, hence cache_dir must be a trusted directory
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+
+    def _entry_file(self, key):
+        return os.path.join(self.cache_dir, key + '.pickle')
+
+
+    def get(self, key):
+        """ return the stored dict of results, or None """
+        path = self._entry_file(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        # mark as recently used
+        os.utime(path)
+        cverr(1, 'INFO: query result cache hit %s' % key)
+        return entry
+
+
+    def put(self, key, entry):
+        """ store dict of results under key, and evict old entries """
+        path = self._entry_file(key)
+        tmp_file = '%s.%s' % (path, random_string(6))
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, path)
+        self.evict()
+
+
+    def evict(self):
+        """ remove least recently used entries until the cache fits max_size """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.pickle'):
+                continue
+            st = os.stat( os.path.join(self.cache_dir, name) )
+            entries.append( (st.st_mtime, st.st_size, name) )
+
+        total = sum( e[1] for e in entries )
+        entries.sort()
+        for (mtime, size, name) in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove( os.path.join(self.cache_dir, name) )
+            except FileNotFoundError:
+                pass
+            total -= size
+            cverr(1, 'INFO: query result cache evicted %s' % name)
+
+
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.pickle'):
+                os.remove( os.path.join(self.cache_dir, name) )
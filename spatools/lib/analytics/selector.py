@@ -1,6 +1,7 @@
 
 from itertools import cycle
 from spatools.lib.analytics.sampleset import SampleSet, SampleSetContainer
+from spatools.lib.analytics.dist import get_metric
 from spatools.lib.const import peaktype
 
 colour_scheme = {
@@ -179,10 +180,13 @@ class Filter(object):
         self.marker_ids = None
         self.species = None
         self.abs_threshold = 0      # includes alelles above rfu
+        self.rel_threshold = 0.0        # includes alleles of at least % of highest rfu
         self.rel_cutoff = 0.0         # excludes alleles above % of highest rfu [ rel_threshold < height < rel_cutoff ]
         self.sample_qual_threshold = 0.0    # includes samples with marker more than %
         self.marker_qual_threshold = 0.0    # includes markers with sample more than %
         self.sample_options = None
+        self.genotype_storage = 'dense'     # dense: uint8 per call, packed: 2-bit per call
+        self.genotype_depths = False        # keep read counts of A, C, G, T in genotype matrix
 
 
     @classmethod
@@ -193,9 +197,16 @@ class Filter(object):
         params.marker_ids = d.get('marker_ids', None)
         params.panel_ids = d.get('panel_ids', None)
         params.abs_threshold = int( d['abs_threshold'] )
+        params.rel_threshold = float( d.get('rel_threshold', 0.0) )
         params.sample_qual_threshold = float( d['sample_qual_threshold'] )
         params.marker_qual_threshold = float( d['marker_qual_threshold'] )
         params.sample_filtering = d.get('sample_filtering', 'N')
+        params.genotype_storage = d.get('genotype_storage', 'dense')
+        # depth-aware distance metrics and MoI sample filtering need the read counts
+        metric = (opts or {}).get('distance_metric', 'simple')
+        params.genotype_depths = ( bool(d.get('genotype_depths', False))
+                                    or get_metric(metric).requires_depths
+                                    or params.sample_filtering.upper() in ('M', 'S') )
         return params
 
 
@@ -0,0 +1,217 @@
+#
+# treeplot.py
+#
+# Tree layout and rendering with matplotlib
+# =========================================
+#
+# layouts compute the (x, y) position of each node of nj.Tree:
+#   rectangular: x is the distance from the root, tips are evenly spaced on y
+#   fan:         polar version of rectangular, tips evenly spaced on angle
+#   unrooted:    equal-angle layout, each subtree gets a wedge proportional
+#                to its number of tips
+#
+# branches are drawn as a single LineCollection.  With branch colouring, tip
+# branches take the colour of the tip, and an internal branch takes the colour
+# of its children if they all have the same colour, or grey otherwise.
+#
+
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+
+from spatools.lib.analytics.nj import newick_label
+
+default_colour = '#474747'
+
+
+def branch_colours( tree, tip_colours ):
+    """ return list of colour of the branch leading to each node """
+    colours = [ default_colour ] * tree.n_nodes
+    colours[:tree.n_tips] = tip_colours
+    children = tree.children
+    for node in tree.postorder():
+        if node < tree.n_tips:
+            continue
+        child_colours = set( colours[c] for c in children[node] )
+        if len(child_colours) == 1:
+            colours[node] = child_colours.pop()
+    return colours
+
+
+def preorder( tree ):
+    """ return array of nodes with parents before their children """
+    return tree.postorder()[::-1]
+
+
+def node_depths( tree ):
+    """ return distance of each node from the root, ignoring negative branches """
+    depth = np.zeros(tree.n_nodes)
+    length = np.maximum(tree.length, 0)
+    for node in preorder(tree)[1:]:
+        depth[node] = depth[tree.parent[node]] + length[node]
+    return depth
+
+
+def tip_positions( tree ):
+    """ return position (0..n_tips-1) of each node in the order of traversal,
+        internal nodes take the mean position of their children
+    """
+    pos = np.zeros(tree.n_nodes)
+    order = [ node for node in preorder(tree) if node < tree.n_tips ]
+    # preorder visits children in reverse order
+    pos[ order[::-1] ] = np.arange(tree.n_tips)
+    children = tree.children
+    for node in tree.postorder():
+        if node >= tree.n_tips:
+            pos[node] = np.mean( pos[ children[node] ] )
+    return pos
+
+
+def layout_rectangular( tree ):
+    """ return (xy, segments, segment_nodes) """
+    x = node_depths(tree)
+    y = tip_positions(tree)
+    segments, owners = [], []
+    children = tree.children
+    for node in range(tree.n_nodes):
+        p = tree.parent[node]
+        if p >= 0:
+            segments.append( ((x[p], y[node]), (x[node], y[node])) )
+            owners.append(node)
+        if children[node]:
+            ys = y[ children[node] ]
+            segments.append( ((x[node], ys.min()), (x[node], ys.max())) )
+            owners.append(node)
+    return (np.column_stack([x, y]), segments, owners)
+
+
+def layout_fan( tree, arc_steps = 16 ):
+    """ return (xy, segments, segment_nodes) """
+    r = node_depths(tree)
+    theta = 2 * np.pi * tip_positions(tree) / tree.n_tips
+    segments, owners = [], []
+    children = tree.children
+    for node in range(tree.n_nodes):
+        p = tree.parent[node]
+        if p >= 0:
+            c, s = np.cos(theta[node]), np.sin(theta[node])
+            segments.append( ((r[p] * c, r[p] * s), (r[node] * c, r[node] * s)) )
+            owners.append(node)
+        if children[node]:
+            ts = theta[ children[node] ]
+            arc = np.linspace( ts.min(), ts.max(), arc_steps )
+            segments.append( np.column_stack([ r[node] * np.cos(arc), r[node] * np.sin(arc) ]) )
+            owners.append(node)
+    xy = np.column_stack([ r * np.cos(theta), r * np.sin(theta) ])
+    return (xy, segments, owners)
+
+
+def layout_unrooted( tree ):
+    """ return (xy, segments, segment_nodes) using equal-angle algorithm """
+    n_nodes = tree.n_nodes
+    children = tree.children
+    tips = np.zeros(n_nodes)
+    tips[:tree.n_tips] = 1
+    for node in tree.postorder():
+        for c in children[node]:
+            tips[node] += tips[c]
+
+    xy = np.zeros( (n_nodes, 2) )
+    start = np.zeros(n_nodes)
+    wedge = np.zeros(n_nodes)
+    wedge[tree.root] = 2 * np.pi
+    length = np.maximum(tree.length, 0)
+    segments, owners = [], []
+    for node in preorder(tree):
+        a = start[node]
+        for c in children[node]:
+            start[c] = a
+            wedge[c] = wedge[node] * tips[c] / tips[node]
+            angle = a + wedge[c] / 2
+            xy[c] = xy[node] + length[c] * np.array([ np.cos(angle), np.sin(angle) ])
+            a += wedge[c]
+            segments.append( (tuple(xy[node]), tuple(xy[c])) )
+            owners.append(c)
+    return (xy, segments, owners)
+
+
+layouts = {
+    'rectangular': layout_rectangular,
+    'phylogram': layout_rectangular,
+    'fan': layout_fan,
+    'unrooted': layout_unrooted,
+}
+
+
+def plot_tree( tree, filename, tree_type = 'fan', tip_colours = None, tip_labels = None,
+                legend = None, branch_coloring = True, figsize = (11.2, 7), dpi = 100,
+                linewidth = 0.8, fontsize = 5 ):
+    """ plot tree to filename using matplotlib
+        tip_colours: list of colour of each tip
+        tip_labels: optional list of label of each tip
+        legend: optional list of (label, colour)
+    """
+
+    if tree_type not in layouts:
+        raise RuntimeError('unknown tree type: %s' % tree_type)
+
+    tip_colours = tip_colours or [ default_colour ] * tree.n_tips
+    if branch_coloring:
+        colours = branch_colours(tree, tip_colours)
+    else:
+        colours = [ default_colour ] * tree.n_nodes
+
+    xy, segments, owners = layouts[tree_type](tree)
+
+    fig = plt.figure(figsize = figsize, dpi = dpi)
+    ax = fig.add_subplot(111)
+    ax.add_collection( LineCollection( segments, colors = [ colours[o] for o in owners ],
+                        linewidths = linewidth ) )
+
+    if tip_labels:
+        for i in range(tree.n_tips):
+            ax.text( xy[i, 0], xy[i, 1], ' ' + str(tip_labels[i]), color = tip_colours[i],
+                        fontsize = fontsize, va = 'center' )
+
+    ax.autoscale()
+    ax.set_aspect('equal' if tree_type != 'rectangular' and tree_type != 'phylogram'
+                        else 'auto')
+    ax.axis('off')
+
+    artists = ()
+    if legend:
+        handles = [ plt.Line2D([], [], color = colour) for (_, colour) in legend ]
+        leg = ax.legend( handles, [ label for (label, _) in legend ], loc = 'upper right',
+                        fontsize = 'x-small' )
+        artists = (leg,)
+    fig.savefig( filename, bbox_extra_artists = artists, bbox_inches = 'tight' )
+    plt.close(fig)
+    return filename
+
+
+def write_newick( tree, outstream, tip_colours = None, branch_coloring = True,
+                    label_func = None ):
+    """ write Newick with colour of each branch as [&!color=...] comments,
+        as read by FigTree
+    """
+    comments = None
+    if tip_colours:
+        colours = ( branch_colours(tree, tip_colours) if branch_coloring
+                    else list(tip_colours) + [ default_colour ] * (tree.n_nodes - tree.n_tips) )
+        comments = [ '&!color=%s' % c for c in colours ]
+    outstream.write( tree.to_newick( label_func, comments = comments ) )
+    outstream.write( '\n' )
+
+
+def write_nexus( tree, outstream, tip_colours = None, branch_coloring = True,
+                    label_func = None ):
+    """ write NEXUS with taxa block and the tree with colour comments """
+    label_func = label_func or str
+    outstream.write( '#NEXUS\n\nbegin taxa;\n' )
+    outstream.write( '\tdimensions ntax=%d;\n\ttaxlabels\n' % tree.n_tips )
+    for i, label in enumerate(tree.labels):
+        colour = '[&!color=%s]' % tip_colours[i] if tip_colours else ''
+        outstream.write( '\t%s%s\n' % (newick_label( label_func(label) ), colour) )
+    outstream.write( ';\nend;\n\nbegin trees;\n\ttree tree_1 = [&U] ' )
+    write_newick( tree, outstream, tip_colours, branch_coloring, label_func )
+    outstream.write( 'end;\n' )
@@ -48,6 +48,18 @@ def init_argparser(p = None):
     p.add_argument('--infile', default='',
             help = 'input file')
 
+    p.add_argument('--cachedir', default='',
+            help = 'directory for columnar genotype cache')
+
+    p.add_argument('--outfile', default='pca.png',
+            help = 'output file')
+
+    p.add_argument('--groupby', default='batch', choices = ['batch', 'category'],
+            help = 'sample metadata for grouping samples in PCA plot')
+
+    p.add_argument('--chunksize', default=500, type=int,
+            help = 'number of samples read from database at a time')
+
     # db update related
 
     p.add_argument('--commit', default=False, action='store_true',
@@ -86,6 +98,9 @@ def do_dbmgr( args, dbh = None, warning = True ):
     if not dbh:
         dbh = get_dbhandler(args, initial = args.initdb)
 
+    if args.cachedir:
+        dbh.set_genotype_cache(args.cachedir)
+
     if args.initbatch is not False:
         do_initbatch(args, dbh)
 
@@ -287,6 +302,9 @@ def do_uploadgenotypes(args, dbh):
 
         dbh.session().flush()
 
+    # genotypes of this batch have changed
+    dbh.bump_batch_version(batch.id)
+
     cerr('WARN: assays %d' % len(assay_set))
 
     cerr('INFO: found %d samples, not found %s samples' % (exists, not_exists))
@@ -381,6 +399,9 @@ def do_uploadvcf(args, dbh):
 
     dbh.session().flush()
 
+    # genotypes of this batch have changed
+    dbh.bump_batch_version(batch.id)
+
 
 def do_importpanels(args, dbh):
 
@@ -416,43 +437,77 @@ def basecall( assay_data ):
     import IPython
     IPython.embed()
 
-class V:
-    pass
-
 def do_createpca(args, dbh):
 
-    """ a shortcut to create PCA from all samples based on country """
-
-    df = dbh.get_allele_dataframe(None, None, None)
-    import pandas
+    """ create PCA of all samples (or samples of a batch) in the database,
+        streaming chunks of samples from the database in two passes: the
+        first pass fits an incremental PCA of the sparse one-hot encoded
+        calls, and the second pass projects the samples
+    """
 
-    variant_df = pandas.pivot_table( df, index = 'sample_id', columns = 'locus_id', values='call',
-                aggfunc = lambda x: x )
-
-    from spatools.lib.analytics import dist
+    from spatools.lib.analytics.genotype import GenotypeMatrix, call_codes, encode_calls
+    from spatools.lib.analytics.selector import colour_scheme
     from spatools.lib.analytics import ca
-
-    D = dist.simple_distance(variant_df)
-
-    DM = V()
-    DM.M = D[0]
-
-    res = ca.pcoa( DM )
-
+    from itertools import cycle
+    import numpy as np
     import matplotlib.pyplot as plt
-    axis = [ (0, 39), (40, 59), (60, 71), (72, 85), (86, 125), (126, 131) ]
+
+    # samples and their groups from metadata
+    q = dbh.session().query( dbh.Sample.id, dbh.Sample.batch_id, dbh.Sample.category )
+    if args.batch:
+        q = q.filter( dbh.Sample.batch_id == dbh.get_batch(args.batch).id )
+    samples = q.order_by( dbh.Sample.id ).all()
+    if not samples:
+        cexit('ERR: no samples found')
+    sample_ids = np.array( [ s[0] for s in samples ] )
+    if args.groupby == 'batch':
+        codes = { batch_id: dbh.get_batch_by_id(batch_id).code
+                    for batch_id in set( s[1] for s in samples ) }
+        groups = [ codes[batch_id] for (_, batch_id, _) in samples ]
+    else:
+        groups = [ str(category) for (_, _, category) in samples ]
+
+    # one-hot columns only for the (locus, call) observed in the database
+    observed = dbh.session().query( dbh.Genotype.locus_id, dbh.Genotype.call ).distinct().all()
+    locus_ids = np.unique( [ l for (l, _) in observed ] )
+    present = np.zeros( (len(locus_ids), len(call_codes)), dtype=bool )
+    present[ np.searchsorted(locus_ids, [ l for (l, _) in observed ]),
+             encode_calls( [ c for (_, c) in observed ] ) ] = True
+    columns = ca.indicator_columns( present )
+    cerr('[I - PCA of %d samples x %d loci, %d one-hot columns]'
+            % (len(sample_ids), len(locus_ids), (columns >= 0).sum()))
+
+    def encoded_chunks():
+        for chunk_ids, df in dbh.iter_allele_dataframes( sample_ids.tolist(), args.chunksize ):
+            matrix = GenotypeMatrix.from_dataframe( df, sample_ids = chunk_ids,
+                                                    locus_ids = locus_ids )
+            yield ca.onehot_calls( matrix.calls, columns )
+
+    ipca = ca.IncrementalPCA( dim = 2 )
+    for X in encoded_chunks():
+        ipca.partial_fit( X )
+    pca_matrix = np.vstack( [ ipca.transform( X ) for X in encoded_chunks() ] )
+    pca_var = ipca.explained_variance_ratio
+
+    # write coordinates and plot
+    with open( os.path.splitext(args.outfile)[0] + '.txt', 'w' ) as out:
+        out.write( 'SAMPLE\tGROUP\tPC1\tPC2\n' )
+        for sample_id, group, (pc1, pc2) in zip( sample_ids, groups, pca_matrix ):
+            out.write( '%d\t%s\t%5.4f\t%5.4f\n' % (sample_id, group, pc1, pc2) )
 
     fig = plt.figure()
     ax = fig.add_subplot(111)
-
-    pca_matrix = res[0]
-    pca_var = res[1]
-
-    for (i1, i2) in axis:
-        ax.scatter( pca_matrix[i1:i2, 0], pca_matrix[i1:i2, 1] )
-
-    fig.savefig('test.png')
-
-
-    #import IPython
-    #IPython.embed()
+    groups = np.array(groups)
+    colours = cycle( colour_scheme['vega20'] )
+    for group in sorted(set(groups)):
+        idx = groups == group
+        colour = next(colours)
+        ax.scatter( pca_matrix[idx, 0], pca_matrix[idx, 1], c = colour,
+                    label = group, marker = '+', s = 30, alpha = 0.75 )
+    ax.set_xlabel('PC1 (%.3f%%)' % pca_var[0])
+    ax.set_ylabel('PC2 (%.3f%%)' % pca_var[1])
+    leg = ax.legend(loc='upper left', scatterpoints=1, fontsize='x-small', fancybox=True,
+            bbox_to_anchor=(1,1))
+    fig.savefig( args.outfile, bbox_extra_artists=(leg,), bbox_inches='tight' )
+    plt.close()
+    cerr('[I - PCA plot written to %s]' % args.outfile)
@@ -0,0 +1,115 @@
+#
+# genocache.py
+#
+# Columnar on-disk cache for genotype rows
+# ========================================
+#
+# Genotype rows of each batch are stored as one NumPy .npy file per column:
+#
+#   <cache_dir>/batch-<batch_id>/meta.json   version, row count and dtypes of the columns
+#   <cache_dir>/batch-<batch_id>/<column>.npy
+#
+# The columns are memory-mapped on read.  The data version of a batch is kept
+# in the database by the handler, and is bumped in the same transaction as any
+# genotype upload to the batch; columns stored at an older version are stale
+# and are rebuilt by the handler on the next request.  The handler stores the
+# rows ordered by sample_id, so that the rows of samples are read by range.
+#
+
+import os, json, shutil
+import numpy as np
+
+from spatools.lib.utils import cverr, random_string
+
+
+# layout of the stored columns, columns stored with another layout are stale
+cache_format = 2
+
+
+class GenotypeCache(object):
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+
+    def _batch_dir(self, batch_id):
+        return os.path.join(self.cache_dir, 'batch-%d' % batch_id)
+
+
+    def meta(self, batch_id):
+        try:
+            with open(os.path.join(self._batch_dir(batch_id), 'meta.json')) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+
+    def is_fresh(self, batch_id, version, rows=None, dtypes=None):
+        """ check whether the stored columns of the batch match the current data
+            version, and optionally the current number of genotype rows and
+            the dict of { column_name: dtype } expected by the caller
+        """
+        meta = self.meta(batch_id)
+        if meta is None or meta.get('format') != cache_format or meta['version'] != version:
+            return False
+        if rows is not None and meta['rows'] != rows:
+            return False
+        if dtypes is not None and meta.get('dtypes') != {
+                    name: np.dtype(dtype).str for name, dtype in dtypes.items() }:
+            return False
+        return True
+
+
+    def store(self, batch_id, columns, version):
+        """ store dict of { column_name: numpy array } for the batch at the data
+            version the columns were read at
+        """
+
+        batch_dir = self._batch_dir(batch_id)
+        tmp_dir = '%s.%s' % (batch_dir, random_string(6))
+        os.makedirs(tmp_dir)
+
+        rows = None
+        dtypes = {}
+        for name, values in columns.items():
+            values = np.asarray(values)
+            if rows is None:
+                rows = len(values)
+            elif len(values) != rows:
+                raise RuntimeError('column %s has inconsistent length' % name)
+            np.save(os.path.join(tmp_dir, name + '.npy'), values, allow_pickle=False)
+            dtypes[name] = values.dtype.str
+
+        # meta.json is written last, so an incomplete directory is never fresh
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump( { 'format': cache_format, 'version': version, 'rows': rows or 0,
+                         'columns': list(columns.keys()), 'dtypes': dtypes }, f )
+
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        os.rename(tmp_dir, batch_dir)
+        cverr(1, 'INFO: genotype cache stored %d rows for batch %d at version %d'
+                    % (rows or 0, batch_id, version))
+
+
+    def load(self, batch_id, mmap=True):
+        """ return dict of { column_name: numpy array }, memory-mapped by default """
+
+        meta = self.meta(batch_id)
+        if meta is None:
+            raise RuntimeError('genotype cache for batch %d does not exist' % batch_id)
+        batch_dir = self._batch_dir(batch_id)
+        return { name: np.load(os.path.join(batch_dir, name + '.npy'),
+                            mmap_mode = 'r' if mmap else None, allow_pickle=False)
+                    for name in meta['columns'] }
+
+
+    def clear(self, batch_id=None):
+        """ remove stored columns of the batch, or of all batches """
+        if batch_id is not None:
+            shutil.rmtree(self._batch_dir(batch_id), ignore_errors=True)
+            return
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith('batch-') and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
@@ -1,6 +1,27 @@
 
-from pandas import DataFrame, concat
+import numpy as np
+from pandas import DataFrame
+from sqlalchemy import Table, Column, Integer, MetaData, func
 from sqlalchemy.orm.exc import NoResultFound
+from spatools.lib.utils import cerr
+from spatools.lib.analytics.genotype import encode_calls, call_categorical
+
+
+allele_columns = ( 'locus_id', 'sample_id', 'call', 'A', 'C', 'G', 'T', 'genotype_id' )
+
+# storage type of allele_columns, call is stored as uint8 code (see genotype.py)
+allele_dtypes = { 'locus_id': np.int32, 'sample_id': np.int32, 'call': np.uint8,
+                  'A': np.int32, 'C': np.int32, 'G': np.int32, 'T': np.int32,
+                  'genotype_id': np.int32 }
+
+# read depths may be NULL in the database, and are stored as 0
+depth_columns = ( 'A', 'C', 'G', 'T' )
+
+# data version of the genotypes of each batch, bumped in the same transaction
+# as any genotype upload to the batch; batches without a row are at version 0
+genotype_versions = Table( 'genotype_versions', MetaData(),
+                        Column( 'batch_id', Integer, primary_key=True ),
+                        Column( 'version', Integer, nullable=False ) )
 
 
 def chunks(l, n):
@@ -8,12 +29,34 @@ def chunks(l, n):
         yield l[i:i + n]
 
 
+def concat_columns(parts):
+    """ concatenate list of dict of column arrays """
+    if not parts:
+        return { c: np.zeros(0, dtype = allele_dtypes[c]) for c in allele_columns }
+    return { c: np.concatenate( [ p[c] for p in parts ] ) for c in allele_columns }
+
+
+def allele_dataframe(columns):
+    """ return allele dataframe from dict of typed column arrays """
+    columns = dict(columns)
+    columns['call'] = call_categorical( columns['call'] )
+    return DataFrame( columns, columns = allele_columns )
+
+
 class base_sqlhandler(object):
     """ base class for SQLAlchemy-friendly handler """
 
     Batch = None
     Sample = None
 
+    genotype_cache = None
+
+    # how get_allele_dataframe selects sample_ids:
+    #   'chunk'     - one query per IN (...) list of 250 sample_ids
+    #   'temptable' - single join against a temporary table of sample_ids
+    #   'auto'      - temptable if sample_ids do not fit in a single chunk
+    sample_selection = 'auto'
+
     def __init__(self):
         self.engine = None
         self.session = None
@@ -109,37 +152,267 @@ class base_sqlhandler(object):
 
     def get_allele_dataframe(self, sample_ids, locus_ids, params):
         """ return a Pandas dataframe with this columns
-            ( marker_id, sample_id, basecall )
+            ( locus_id, sample_id, call, A, C, G, T, genotype_id )
+            with compact dtypes (see allele_dtypes) and call as categorical
+            sample_ids = None returns genotypes of all samples
+            if a genotype cache has been set, the dataframe is served from the cache
         """
 
-        q = self.session().query( self.Genotype.locus_id,
-                        self.Genotype.sample_id, self.Genotype.call,
-                        self.Genotype.A, self.Genotype.C,
-                        self.Genotype.G, self.Genotype.T,
-                        self.Genotype.sample_id )
+        if self.genotype_cache is not None:
+            return self.get_cached_allele_dataframe(sample_ids, locus_ids, params)
+
+        q = self.query_genotypes()
         if locus_ids:
             q = q.filter( self.Genotype.locus_id.in_(locus_ids))
 
+        if sample_ids is None:
+            return allele_dataframe( self.fetch_allele_columns(q) )
+
+        if self.use_sample_table(sample_ids):
+            # single join against temporary table of sample_ids
+            table = self.create_sample_table(sample_ids)
+            q = q.join( table, table.c.sample_id == self.Genotype.sample_id )
+            return allele_dataframe( self.fetch_allele_columns(q, q.count()) )
+
+        # we need to breakdown the query per 250 to avoid
+        # errors with SQLite (or any other )
+        parts = []
+        for partial_sample_ids in chunks( list(sample_ids), 250):
+
+            partial_q = q.filter( self.Genotype.sample_id.in_(partial_sample_ids))
+            parts.append( self.fetch_allele_columns(partial_q) )
+
+        return allele_dataframe( concat_columns(parts) )
+
+
+    def fetch_allele_columns(self, q, rows=None, batch_size=50000):
+        """ return dict of typed NumPy arrays of allele_columns, reading the
+            result of q by batches; the arrays are pre-allocated if rows is
+            given, otherwise they are grown as necessary; NULL depths are read
+            as 0
+        """
+        size = rows if rows is not None else batch_size
+        columns = { c: np.empty(size, dtype = allele_dtypes[c]) for c in allele_columns }
+
+        result = self.session().execute(q.statement)
+        pos = 0
+        while True:
+            batch = result.fetchmany(batch_size)
+            if not batch:
+                break
+            end = pos + len(batch)
+            if end > size:
+                if rows is not None:
+                    raise RuntimeError('genotype rows exceed pre-allocated size of %d' % rows)
+                size = max(end, 2 * size)
+                for c in allele_columns:
+                    grown = np.empty(size, dtype = allele_dtypes[c])
+                    grown[:pos] = columns[c][:pos]
+                    columns[c] = grown
+            for c, values in zip(allele_columns, zip(*batch)):
+                if c == 'call':
+                    columns[c][pos:end] = encode_calls(values)
+                elif c in depth_columns:
+                    columns[c][pos:end] = [ 0 if x is None else x for x in values ]
+                else:
+                    columns[c][pos:end] = values
+            pos = end
+
+        return { c: v[:pos] for c, v in columns.items() }
+
+
+    ## sample selection
+
+    def use_sample_table(self, sample_ids):
+        """ check whether sample_ids should be selected using temporary table """
+        if self.sample_selection == 'temptable':
+            return True
+        if self.sample_selection == 'auto':
+            return len(sample_ids) > 250
+        return False
+
+
+    def create_sample_table(self, sample_ids):
+        """ load sample_ids into a temporary table bound to the connection of
+            current session, and return the table
+        """
+        conn = self.session().connection()
+        table = Table( 'tmp_selected_samples', MetaData(),
+                        Column( 'sample_id', Integer, primary_key=True ),
+                        prefixes = [ 'TEMPORARY' ] )
+        table.drop(conn, checkfirst=True)
+        table.create(conn)
         if sample_ids:
-            # we need to breakdown the query per 500 to avoid
-            # errors with SQLite (or any other )
-            dfs = []
-            for partial_sample_ids in chunks( list(sample_ids), 250):
-
-                partial_q = q.filter( self.Genotype.sample_id.in_(partial_sample_ids))
-                dfs.append(
-                    DataFrame( [
-                        (locus_id, sample_id, call, A, C, G, T, genotype_id)
-                        for (locus_id, sample_id, call, A, C, G, T, genotype_id)
-                        in partial_q
-                    ] )
-                )
-
-        df = concat( dfs )
-        df.columns = ( 'locus_id', 'sample_id', 'call',
-                        'A', 'C', 'G', 'T', 'genotype_id' )
+            conn.execute( table.insert(), [ { 'sample_id': int(x) } for x in sample_ids ] )
+        return table
 
-        return df
+
+    def query_genotypes(self):
+        """ return SQLAlchemy query of genotype rows in allele_columns order """
+        return self.session().query( self.Genotype.locus_id,
+                        self.Genotype.sample_id, self.Genotype.call,
+                        self.Genotype.A, self.Genotype.C,
+                        self.Genotype.G, self.Genotype.T,
+                        self.Genotype.id )
+
+
+    ## columnar genotype cache
+
+    def set_genotype_cache(self, cache_dir):
+        from spatools.lib.genocache import GenotypeCache
+        self.genotype_cache = GenotypeCache(cache_dir) if cache_dir else None
+
+
+    def genotype_version_table(self):
+        """ return table of genotype data versions, creating it if necessary """
+        genotype_versions.create( self.session().connection(), checkfirst=True )
+        return genotype_versions
+
+
+    def bump_batch_version(self, batch_id):
+        """ increase the data version of the genotypes of batch_id in the
+            database, must be called after uploading genotypes to the batch
+        """
+        table = self.genotype_version_table()
+        conn = self.session().connection()
+        updated = conn.execute( table.update().where( table.c.batch_id == batch_id ).values(
+                        version = table.c.version + 1 ) ).rowcount
+        if not updated:
+            conn.execute( table.insert().values( batch_id = batch_id, version = 1 ) )
+        if self.genotype_cache is not None:
+            self.genotype_cache.clear(batch_id)
+
+
+    def batch_data_versions(self, batch_ids):
+        """ return dict of { batch_id: (data version, genotype rows) } of
+            batch_ids, read from the database in a single query
+        """
+        if not batch_ids:
+            return {}
+        table = self.genotype_version_table()
+        q = self.session().query( self.Sample.batch_id,
+                        func.max(table.c.version), func.count(self.Genotype.id) ).join(
+                        self.Genotype, self.Genotype.sample_id == self.Sample.id ).outerjoin(
+                        table, table.c.batch_id == self.Sample.batch_id ).filter(
+                        self.Sample.batch_id.in_(batch_ids) ).group_by( self.Sample.batch_id )
+        versions = { batch_id: (version or 0, rows) for batch_id, version, rows in q }
+        # batches without genotypes are not returned by the join
+        return { batch_id: versions.get(batch_id, (0, 0)) for batch_id in batch_ids }
+
+
+    def get_data_versions(self, sample_ids):
+        """ return dict of { batch_id: (data version, genotype rows) } of batches
+            containing the samples
+        """
+        return self.batch_data_versions( self.get_batch_ids_by_sample_ids(sample_ids) )
+
+
+    def get_batch_ids_by_sample_ids(self, sample_ids):
+        """ return sorted list of batch_id containing the samples """
+        q = self.session().query( self.Sample.batch_id ).distinct()
+        if sample_ids is None:
+            return sorted( b for (b,) in q )
+        if self.use_sample_table(sample_ids):
+            table = self.create_sample_table(sample_ids)
+            return sorted( b for (b,)
+                    in q.join( table, table.c.sample_id == self.Sample.id ) )
+        batch_ids = set()
+        for partial_sample_ids in chunks( list(sample_ids), 250):
+            batch_ids.update( b for (b,)
+                    in q.filter( self.Sample.id.in_(partial_sample_ids)) )
+        return sorted(batch_ids)
+
+
+    def query_batch_genotypes(self, batch_id):
+        return self.query_genotypes().join( self.Sample,
+                        self.Genotype.sample_id == self.Sample.id ).filter(
+                        self.Sample.batch_id == batch_id )
+
+
+    def cache_batch_genotypes(self, batch_id, version):
+        """ read all genotypes of batch_id from the database, ordered by
+            sample_id, and store them in the genotype cache at data version
+        """
+        q = self.query_batch_genotypes(batch_id).order_by( self.Genotype.sample_id )
+        self.genotype_cache.store(batch_id, self.fetch_allele_columns(q), version)
+
+
+    def refresh_genotype_cache(self, batch_ids):
+        """ refresh the cache of any batch whose data version in the database or
+            row count has changed, and return dict of { batch_id: memory-mapped
+            columns } of batch_ids
+        """
+        cache = self.genotype_cache
+        versions = self.batch_data_versions(batch_ids)
+        batches = {}
+        for batch_id in batch_ids:
+            version, rows = versions[batch_id]
+            if not cache.is_fresh(batch_id, version, rows, allele_dtypes):
+                cerr('INFO: refreshing genotype cache for batch %d' % batch_id)
+                self.cache_batch_genotypes(batch_id, version)
+            batches[batch_id] = cache.load(batch_id)
+        return batches
+
+
+    def select_cached_columns(self, batches, sample_ids, locus_ids):
+        """ return dict of typed column arrays of sample_ids and locus_ids (sorted
+            int64 arrays, or None for all) from the cached columns of batches;
+            only the rows within the range of sample_ids are read
+        """
+        parts = []
+        for columns in batches.values():
+            rows = slice(None)
+            if sample_ids is not None and len(sample_ids) == 0:
+                rows = slice(0, 0)
+            elif sample_ids is not None:
+                # cached rows are ordered by sample_id
+                column = columns['sample_id']
+                rows = slice( np.searchsorted(column, sample_ids[0]),
+                              np.searchsorted(column, sample_ids[-1], 'right') )
+            selected = { c: np.asarray(v[rows]) for c, v in columns.items() }
+            mask = None
+            if sample_ids is not None:
+                mask = np.isin(selected['sample_id'], sample_ids)
+            if locus_ids is not None:
+                locus_mask = np.isin(selected['locus_id'], locus_ids)
+                mask = locus_mask if mask is None else mask & locus_mask
+            if mask is not None and not mask.all():
+                selected = { c: v[mask] for c, v in selected.items() }
+            parts.append( selected )
+        return concat_columns(parts)
+
+
+    def get_cached_allele_dataframe(self, sample_ids, locus_ids, params):
+        """ return allele dataframe from memory-mapped genotype cache, refreshing
+            the cache of any batch whose data version in the database or row
+            count has changed
+        """
+
+        batches = self.refresh_genotype_cache( self.get_batch_ids_by_sample_ids(sample_ids) )
+        if sample_ids is not None:
+            sample_ids = np.unique( np.fromiter(sample_ids, dtype=np.int64) )
+        locus_ids = np.unique( np.fromiter(locus_ids, dtype=np.int64) ) if locus_ids else None
+        return allele_dataframe( self.select_cached_columns(batches, sample_ids, locus_ids) )
+
+
+    def iter_allele_dataframes(self, sample_ids, chunk_size, locus_ids=None, params=None):
+        """ yield (chunk of sample_ids, allele dataframe) of consecutive chunks
+            of sample_ids; with a genotype cache, the cache is checked once and
+            the rows of each chunk are read from the range of its sample_ids,
+            hence sample_ids should be sorted
+        """
+        sample_ids = list(sample_ids)
+        if self.genotype_cache is None:
+            for chunk in chunks(sample_ids, chunk_size):
+                yield (chunk, self.get_allele_dataframe(chunk, locus_ids, params))
+            return
+
+        batches = self.refresh_genotype_cache( self.get_batch_ids_by_sample_ids(sample_ids) )
+        locus_ids = np.unique( np.fromiter(locus_ids, dtype=np.int64) ) if locus_ids else None
+        for chunk in chunks(sample_ids, chunk_size):
+            columns = self.select_cached_columns( batches,
+                            np.unique( np.array(chunk, dtype=np.int64) ), locus_ids )
+            yield (chunk, allele_dataframe(columns))
 
 
     def get_allele_dataframe_xxx(self, sample_ids, marker_ids, params):
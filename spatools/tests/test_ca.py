@@ -0,0 +1,50 @@
+
+import unittest
+
+import numpy as np
+
+from spatools.lib.analytics.ca import (IncrementalPCA, indicator_matrix,
+            indicator_columns, onehot_calls)
+
+
+class TestIncrementalPCA(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(13)
+        # two populations with different allele frequencies
+        freqs = rng.uniform(0.1, 0.9, (2, 60))
+        pops = np.repeat( [0, 1], 60 )
+        self.calls = np.where( rng.random((120, 60)) < freqs[pops], 1, 2 ).astype(np.uint8)
+        self.calls[ rng.random((120, 60)) < 0.05 ] = 0
+
+    def test_onehot_calls(self):
+        Z, loci = indicator_matrix(self.calls)
+        np.testing.assert_array_equal( loci, np.repeat(np.arange(60), 2) )
+        # missing calls have no column even if marked
+        column = indicator_columns( np.isin(np.arange(7), [0, 1, 2])[None, :].repeat(60, 0) )
+        X = onehot_calls(self.calls, column, block=16)
+        self.assertEqual( X.shape, (120, 120) )
+        np.testing.assert_array_equal( X.toarray(), Z.toarray() )
+        np.testing.assert_array_equal( X.sum(axis=1).A1, (self.calls != 0).sum(axis=1) )
+
+    def test_matches_full_pca(self):
+        X = onehot_calls( self.calls, indicator_columns(np.ones((60, 7), dtype=bool)) )
+        dense = X.toarray().astype(np.float64)
+        centred = dense - dense.mean(axis=0)
+        U, S, Vt = np.linalg.svd(centred, full_matrices=False)
+        expected = U[:, :2] * S[:2]
+
+        for chunk in (X, dense):
+            ipca = IncrementalPCA( dim = 2, oversampling = 118 )
+            for i in range(0, 120, 32):
+                ipca.partial_fit( chunk[i:i + 32] )
+            coords = ipca.transform(chunk)
+            for k in range(2):
+                sign = np.sign( coords[:, k] @ expected[:, k] )
+                np.testing.assert_allclose( sign * coords[:, k], expected[:, k], atol=1e-6 )
+            np.testing.assert_allclose( ipca.explained_variance_ratio,
+                        S[:2] ** 2 / (S ** 2).sum() * 100, rtol=1e-6 )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+import numpy as np
+
+from spatools.lib.analytics.genotype import GenotypeMatrix
+from spatools.lib.analytics.dist import (condense, squareform, mirror_upper,
+            pairwise_counts, condensed_row, simple_distance, DistanceMatrix)
+
+
+def haplotype_set(label, calls, sample_ids):
+    matrix = GenotypeMatrix( calls, np.asarray(sample_ids), np.arange(calls.shape[1]) )
+    return SimpleNamespace( label = label, colour = 'black', N = len(calls),
+                genotype_matrix = matrix )
+
+
+class TestCondensed(unittest.TestCase):
+
+    def test_roundtrip(self):
+        rng = np.random.default_rng(3)
+        for n in (1, 2, 7, 50):
+            A = rng.random((n, n))
+            M = A + A.T
+            v = condense(M)
+            self.assertEqual( len(v), n * (n + 1) // 2 )
+            np.testing.assert_array_equal( v, M[np.triu_indices(n)] )
+            np.testing.assert_array_equal( squareform(v, n), M )
+            for i in range(n):
+                np.testing.assert_array_equal( condensed_row(v, i, n), M[i] )
+
+    def test_mirror_upper(self):
+        rng = np.random.default_rng(5)
+        A = rng.random((37, 37))
+        G = np.triu(A)
+        mirror_upper(G, tile=8)
+        np.testing.assert_array_equal( G, np.triu(A) + np.triu(A, 1).T )
+
+    def test_pairwise_counts(self):
+        rng = np.random.default_rng(7)
+        calls = rng.integers(0, 3, (20, 15)).astype(np.uint8)
+        mismatches, comparables = pairwise_counts(calls, tile=6)
+        valid = calls != 0
+        both = valid[:, None, :] & valid[None, :, :]
+        differ = both & (calls[:, None, :] != calls[None, :, :])
+        np.testing.assert_array_equal( comparables, both.sum(-1) )
+        np.testing.assert_array_equal( mismatches, differ.sum(-1) )
+
+
+
+class TestIncrementalDistance(unittest.TestCase):
+
+    def test_incremental_matches_full(self):
+        rng = np.random.default_rng(9)
+        calls = rng.integers(0, 4, (30, 25)).astype(np.uint8)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'dist.npz')
+            first = DistanceMatrix( [ haplotype_set('a', calls[:20], range(20)) ] )
+            first.calculate_distance( simple_distance, incremental=path )
+
+            sets = [ haplotype_set('a', calls[:20], range(20)),
+                        haplotype_set('b', calls[20:], range(20, 30)) ]
+            full = DistanceMatrix(sets)
+            full.calculate_distance( simple_distance )
+            for storage in ('dense', 'condensed'):
+                dm = DistanceMatrix(sets, storage)
+                dm.calculate_distance( simple_distance, incremental=path )
+                np.testing.assert_allclose( dm.square(), full.M, rtol=1e-6 )
+                if storage == 'dense':
+                    np.testing.assert_array_equal( dm.V, full.V )
+
+
+if __name__ == '__main__':
+    unittest.main()
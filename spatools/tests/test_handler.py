@@ -0,0 +1,142 @@
+
+import tempfile
+import unittest
+
+import numpy as np
+from sqlalchemy import create_engine, Column, Integer, String
+from sqlalchemy.orm import declarative_base, sessionmaker, scoped_session
+
+from spatools.models.handler_interface import base_sqlhandler
+
+
+Base = declarative_base()
+
+class Batch(Base):
+    __tablename__ = 'batches'
+    id = Column(Integer, primary_key=True)
+    code = Column(String)
+
+class Sample(Base):
+    __tablename__ = 'samples'
+    id = Column(Integer, primary_key=True)
+    batch_id = Column(Integer)
+
+class Genotype(Base):
+    __tablename__ = 'genotypes'
+    id = Column(Integer, primary_key=True)
+    sample_id = Column(Integer)
+    locus_id = Column(Integer)
+    call = Column(String(1))
+    A = Column(Integer)
+    C = Column(Integer)
+    G = Column(Integer)
+    T = Column(Integer)
+
+
+class MemoryHandler(base_sqlhandler):
+    """ handler of in-memory sqlite database """
+
+    Batch = Batch
+    Sample = Sample
+    Genotype = Genotype
+
+    def __init__(self):
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+        self.session = scoped_session(sessionmaker(bind=self.engine))
+
+    def add_genotypes(self, batch_id, rows):
+        """ add rows of (sample_id, locus_id, call, A, C, G, T) to batch_id """
+        session = self.session()
+        if session.get(Batch, batch_id) is None:
+            session.add( Batch(id=batch_id, code='B%d' % batch_id) )
+        for sample_id in sorted( set(r[0] for r in rows) ):
+            if session.get(Sample, sample_id) is None:
+                session.add( Sample(id=sample_id, batch_id=batch_id) )
+        for sample_id, locus_id, call, a, c, g, t in rows:
+            session.add( Genotype(sample_id=sample_id, locus_id=locus_id, call=call,
+                        A=a, C=c, G=g, T=t) )
+        session.commit()
+
+
+class TestAlleleDataFrame(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = MemoryHandler()
+        self.handler.add_genotypes(1, [
+                    (1, 1, 'A', 10, 0, 0, 0),
+                    (1, 2, 'C', None, 7, None, None),
+                    (2, 1, 'G', 0, 0, 5, None),
+                    (2, 2, 'X', None, None, None, None) ])
+
+    def test_null_depths(self):
+        df = self.handler.get_allele_dataframe(None, None, None)
+        self.assertEqual( len(df), 4 )
+        df = df.sort_values('genotype_id')
+        self.assertEqual( df['A'].tolist(), [10, 0, 0, 0] )
+        self.assertEqual( df['C'].tolist(), [0, 7, 0, 0] )
+        self.assertEqual( df['T'].tolist(), [0, 0, 0, 0] )
+        self.assertEqual( df['A'].dtype, np.int32 )
+
+    def test_genotype_id(self):
+        df = self.handler.get_allele_dataframe([1, 2], [1, 2], None)
+        ids = [ g.id for g in self.handler.session().query(Genotype) ]
+        self.assertEqual( sorted(df['genotype_id'].tolist()), sorted(ids) )
+
+
+
+class TestGenotypeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.handler = MemoryHandler()
+        self.handler.add_genotypes(1, [ (1, 1, 'A', 10, 0, 0, 0), (2, 1, 'C', 0, 3, 0, 0) ])
+        self.handler.add_genotypes(2, [ (3, 1, 'G', 0, 0, 4, 0) ])
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def calls(self):
+        df = self.handler.get_allele_dataframe(None, None, None)
+        return dict( zip(df['sample_id'].tolist(), df['call'].astype(str).tolist()) )
+
+    def test_update_without_cache(self):
+        self.handler.set_genotype_cache(self.tmpdir.name)
+        self.assertEqual( self.calls(), { 1: 'A', 2: 'C', 3: 'G' } )
+
+        # rewrite a genotype of batch 1 without the cache, keeping the row count
+        self.handler.set_genotype_cache(None)
+        session = self.handler.session()
+        session.query(Genotype).filter( Genotype.sample_id == 2 ).update( { 'call': 'T' } )
+        self.handler.bump_batch_version(1)
+        session.commit()
+
+        self.handler.set_genotype_cache(self.tmpdir.name)
+        self.assertEqual( self.calls(), { 1: 'A', 2: 'T', 3: 'G' } )
+        self.assertEqual( self.handler.batch_data_versions([1, 2]), { 1: (1, 2), 2: (0, 1) } )
+
+    def test_iter_allele_dataframes(self):
+        self.handler.add_genotypes(1, [ (4, 1, 'T', 0, 0, 0, 2), (4, 2, 'A', 1, 0, 0, 0) ])
+
+        def rows(chunk_size):
+            result = []
+            for chunk, df in self.handler.iter_allele_dataframes([1, 2, 3, 4], chunk_size):
+                result.append( (list(chunk), sorted( zip(df['sample_id'].tolist(),
+                            df['locus_id'].tolist(), df['call'].astype(str).tolist()) )) )
+            return result
+
+        expected = rows(3)
+        self.assertEqual( [ chunk for chunk, _ in expected ], [ [1, 2, 3], [4] ] )
+        self.assertEqual( expected[1][1], [ (4, 1, 'T'), (4, 2, 'A') ] )
+        self.handler.set_genotype_cache(self.tmpdir.name)
+        self.assertEqual( rows(3), expected )
+
+    def test_data_versions(self):
+        # data versions do not depend on the genotype cache
+        self.assertEqual( self.handler.get_data_versions([1, 3]), { 1: (0, 2), 2: (0, 1) } )
+        self.handler.bump_batch_version(2)
+        self.assertEqual( self.handler.get_data_versions([3]), { 2: (1, 1) } )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+
+import unittest
+from types import SimpleNamespace
+
+import numpy as np
+
+from spatools.lib.analytics.genotype import GenotypeMatrix
+from spatools.lib.analytics.he import summarize_he
+
+
+def simulated_set(label, n, loci, rng):
+    """ return analytical set of n samples with biallelic calls and 5% missing """
+    freqs = rng.uniform(0.1, 0.9, loci)
+    calls = np.where( rng.random((n, loci)) < freqs, 1, 2 ).astype(np.uint8)
+    calls[ rng.random((n, loci)) < 0.05 ] = 0
+    matrix = GenotypeMatrix( calls, np.arange(n), np.arange(loci) )
+    return SimpleNamespace( label = label, genotype_matrix = matrix )
+
+
+class TestHeBootstrap(unittest.TestCase):
+
+    def test_ci_contains_estimate(self):
+        rng = np.random.default_rng(11)
+        for n in (10, 25, 100):
+            sets = [ simulated_set('a', n, 40, rng), simulated_set('b', n, 40, rng) ]
+            results = summarize_he( sets, replicates=500, seed=n )
+            for label in ('a', 'b'):
+                lower, upper = results['ci'].loc[label]
+                self.assertLessEqual( lower, results['mean'][label] )
+                self.assertGreaterEqual( upper, results['mean'][label] )
+                locus_ci = results['locus_ci'][label]
+                he = results['data'][label]
+                self.assertTrue( (locus_ci['lower'] <= he + 1e-6).all() )
+                self.assertTrue( (locus_ci['upper'] >= he - 1e-6).all() )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,22 @@
+
+import tempfile
+import unittest
+
+from spatools.lib.analytics.resultcache import get_result_cache
+
+
+class TestQueryResultCache(unittest.TestCase):
+
+    def test_options(self):
+        self.assertIsNone( get_result_cache(None) )
+        self.assertIsNone( get_result_cache( { 'distance_metric': 'simple' } ) )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = get_result_cache( { 'result_cache_dir': tmpdir, 'result_cache_size': '1000' } )
+            self.assertEqual( cache.max_size, 1000 )
+            cache.put( 'key', { 'marker_ids': [1, 2] } )
+            self.assertEqual( cache.get('key'), { 'marker_ids': [1, 2] } )
+            self.assertIsNone( cache.get('other') )
+
+
+if __name__ == '__main__':
+    unittest.main()